@@ -0,0 +1,132 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import NamedTuple, Tuple, List, Optional
+
+from logger import get_logger
+from metrics import ANALYSIS_CACHE_LOOKUPS
+
+
+class CoverAnalysis(NamedTuple):
+    color: Tuple[int, int, int]
+    palette: List[Tuple[int, int, int]]
+
+
+class AnalysisCache:
+    """
+    Two tiered cache for album cover analysis results. Entries are kept in an in-memory
+    LRU and, if a path is given, in a size bounded SQLite database that survives restarts.
+    """
+
+    def __init__(
+        self, path: Optional[str] = None, memory_size: int = 128, disk_size: int = 4096
+    ):
+        self.logger = get_logger("AnalysisCache")
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.entries: "OrderedDict[str, CoverAnalysis]" = OrderedDict()
+        self.lock = Lock()
+        self.connection: Optional[sqlite3.Connection] = None
+
+        if path is not None:
+            try:
+                self.connection = sqlite3.connect(path, check_same_thread=False)
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS analysis ("
+                    "key TEXT PRIMARY KEY, color TEXT NOT NULL, palette TEXT NOT NULL, "
+                    "last_access REAL NOT NULL)"
+                )
+                self.connection.commit()
+            except sqlite3.Error as ex:
+                self.logger.error(f"Failed to open analysis cache at {path}: {ex}")
+                self.connection = None
+
+    @staticmethod
+    def get_key(album_id: Optional[str], image_url: str) -> str:
+        return f"{album_id}|{image_url}"
+
+    def get(self, album_id: Optional[str], image_url: str) -> Optional[CoverAnalysis]:
+        key = self.get_key(album_id, image_url)
+
+        with self.lock:
+            analysis = self.entries.get(key)
+
+            if analysis is not None:
+                self.entries.move_to_end(key)
+                ANALYSIS_CACHE_LOOKUPS.inc("memory")
+                return analysis
+
+            analysis = self.load(key)
+
+            if analysis is not None:
+                self.remember(key, analysis)
+                ANALYSIS_CACHE_LOOKUPS.inc("disk")
+            else:
+                ANALYSIS_CACHE_LOOKUPS.inc("miss")
+
+            return analysis
+
+    def put(self, album_id: Optional[str], image_url: str, analysis: CoverAnalysis):
+        key = self.get_key(album_id, image_url)
+
+        with self.lock:
+            self.remember(key, analysis)
+            self.store(key, analysis)
+
+    def remember(self, key: str, analysis: CoverAnalysis):
+        self.entries[key] = analysis
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.memory_size:
+            self.entries.popitem(last=False)
+
+    def load(self, key: str) -> Optional[CoverAnalysis]:
+        if self.connection is None:
+            return None
+
+        try:
+            row = self.connection.execute(
+                "SELECT color, palette FROM analysis WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            self.connection.execute(
+                "UPDATE analysis SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self.connection.commit()
+        except sqlite3.Error as ex:
+            self.logger.error(f"Failed to read from analysis cache: {ex}")
+            return None
+
+        return CoverAnalysis(
+            color=tuple(json.loads(row[0])),
+            palette=[tuple(color) for color in json.loads(row[1])],
+        )
+
+    def store(self, key: str, analysis: CoverAnalysis):
+        if self.connection is None:
+            return
+
+        try:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO analysis (key, color, palette, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    key,
+                    json.dumps(analysis.color),
+                    json.dumps(analysis.palette),
+                    time.time(),
+                ),
+            )
+            self.connection.execute(
+                "DELETE FROM analysis WHERE key IN ("
+                "SELECT key FROM analysis ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.disk_size,),
+            )
+            self.connection.commit()
+        except sqlite3.Error as ex:
+            self.logger.error(f"Failed to write to analysis cache: {ex}")
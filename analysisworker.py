@@ -0,0 +1,216 @@
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Callable, Dict, Tuple, Optional
+
+from analysiscache import CoverAnalysis
+from logger import get_logger
+from metrics import STAGE_SECONDS, ANALYSIS_JOBS_DROPPED
+
+# Stages timed by the analyser, their durations are passed back to the main process
+ANALYSIS_STAGES = ("decode", "color", "palette")
+
+logger = get_logger("AnalysisWorker")
+
+# Created once per worker process by init_worker
+worker_analyser = None
+
+
+class AnalysisQueueFullError(Exception):
+    """Raised instead of queueing an analysis while max_pending jobs of other keys wait"""
+
+    pass
+
+
+def init_worker(create_analyser: Callable[[], object]):
+    global worker_analyser
+    # Pillow is imported by the worker processes only, unless covers are analysed inline
+    from PIL import Image
+
+    # Load the image plugins now instead of while decoding the first cover
+    Image.init()
+    worker_analyser = create_analyser()
+
+
+def warm_up():
+    pass
+
+
+def analyse_in_worker(data: bytes) -> Tuple[CoverAnalysis, Dict[str, float]]:
+    analysis = worker_analyser.analyse(data)
+    return analysis, {stage: STAGE_SECONDS.get_last(stage) for stage in ANALYSIS_STAGES}
+
+
+def get_result(future: Future) -> Optional[CoverAnalysis]:
+    """
+    :return: The analysis of a completed future or None if it was dropped or failed
+    """
+    if future.cancelled():
+        return None
+
+    try:
+        return future.result()
+    except Exception:
+        logger.exception("Failed to analyse a cover")
+        return None
+
+
+class InlineAnalysisWorker:
+    """
+    Analyses covers in this process, e.g. on single core hosts or for deterministic replays.
+    Without an executor the covers are analysed right away in the calling thread, which
+    must not be an event loop. Jobs are never dropped.
+    """
+
+    def __init__(
+        self, create_analyser: Callable[[], object], executor: Optional[Executor] = None
+    ):
+        """
+        :param executor: Runs the analyses instead of the calling thread, with a single
+        worker as the analyser is not shared between threads
+        """
+        self.create_analyser = create_analyser
+        self.executor = executor
+        # Created for the first cover
+        self.analyser = None
+
+    def analyse(self, data: bytes) -> CoverAnalysis:
+        if self.analyser is None:
+            self.analyser = self.create_analyser()
+
+        return self.analyser.analyse(data)
+
+    def submit(self, key: str, data: bytes) -> Future:
+        if self.executor is not None:
+            return self.executor.submit(self.analyse, data)
+
+        future = Future()
+
+        try:
+            future.set_result(self.analyse(data))
+        except Exception as ex:
+            future.set_exception(ex)
+
+        return future
+
+    def cancel(self, key: str):
+        pass
+
+
+class AnalysisWorker:
+    """
+    Analyses covers in a pool of warm worker processes, so the analysis neither blocks the
+    scheduler nor competes with the MQTT network thread for the GIL. Every key has at most
+    one pending job: a new job cancels the previous one of its key, so the freshest track
+    wins. Jobs of other keys are never dropped, beyond max_pending jobs new ones are refused
+    and have to be submitted again later.
+
+    The pool forks on construction, so create the worker before starting other threads.
+    """
+
+    def __init__(
+        self,
+        create_analyser: Callable[[], object],
+        max_workers: int = 1,
+        max_pending: int = 4,
+    ):
+        """
+        :param create_analyser: Creates the analyser of a worker process, must be picklable
+        :param max_workers: Number of worker processes
+        :param max_pending: Maximum number of queued or running jobs
+        """
+        self.create_analyser = create_analyser
+        self.max_workers = max_workers
+        self.executor = self.create_executor()
+        self.max_pending = max_pending
+        self.pending: "OrderedDict[str, Tuple[Future, Future]]" = OrderedDict()
+        self.lock = Lock()
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(
+            self.max_workers, initializer=init_worker, initargs=(self.create_analyser,)
+        )
+
+        # Start the processes and create the analysers before the first cover arrives
+        for _ in range(self.max_workers):
+            executor.submit(warm_up)
+
+        return executor
+
+    def submit_job(self, data: bytes) -> Future:
+        try:
+            return self.executor.submit(analyse_in_worker, data)
+        except BrokenProcessPool:
+            # A worker process terminated abruptly, e.g. killed for its memory, which
+            # breaks the whole pool. Its jobs have failed, later ones get a new pool.
+            logger.warning("Restarting the analysis worker processes")
+            self.executor.shutdown(wait=False)
+            self.executor = self.create_executor()
+            return self.executor.submit(analyse_in_worker, data)
+
+    def submit(self, key: str, data: bytes) -> Future:
+        """
+        Queue the analysis of an encoded cover
+        :param key: Identifies the consumer of the analysis, e.g. the player
+        :param data: The encoded cover
+        :return: Future of the analysis, cancelled if the job has been dropped
+        :raise AnalysisQueueFullError: If max_pending jobs of other keys are pending
+        """
+        future = Future()
+        job = None
+
+        with self.lock:
+            superseded = self.pending.pop(key, None)
+
+            if len(self.pending) < self.max_pending:
+                job = self.submit_job(data)
+                self.pending[key] = future, job
+
+        # Cancelling runs the callbacks of the jobs, which take the lock
+        if superseded is not None:
+            self.drop("superseded", *superseded)
+
+        if job is None:
+            ANALYSIS_JOBS_DROPPED.inc("overflow")
+            raise AnalysisQueueFullError(f"{self.max_pending} analyses are pending")
+
+        job.add_done_callback(lambda done_job: self.on_done(key, future, done_job))
+        return future
+
+    def cancel(self, key: str):
+        """
+        Drop the pending job of a key, e.g. because the playback has stopped
+        """
+        with self.lock:
+            pending = self.pending.pop(key, None)
+
+        if pending is not None:
+            self.drop("cancelled", *pending)
+
+    @staticmethod
+    def drop(reason: str, future: Future, job: Future):
+        # A running job cannot be stopped, but its result is discarded
+        job.cancel()
+
+        if future.cancel():
+            ANALYSIS_JOBS_DROPPED.inc(reason)
+
+    def on_done(self, key: str, future: Future, job: Future):
+        with self.lock:
+            if self.pending.get(key, (None,))[0] is future:
+                del self.pending[key]
+
+        if job.cancelled() or not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            analysis, timings = job.result()
+        except Exception as ex:
+            future.set_exception(ex)
+            return
+
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage)
+
+        future.set_result(analysis)
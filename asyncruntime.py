@@ -0,0 +1,444 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Optional, Dict, Set, Tuple, Callable
+from urllib.parse import urlencode
+
+import aiohttp
+import paho.mqtt.client as mqtt
+import requests
+
+from analysisworker import AnalysisQueueFullError
+from config import Config
+from governor import RequestDeferredError, parse_retry_after
+from httpcache import HttpCache, get_cache_key
+from logger import get_logger
+from main import (
+    BaseColorScheduler,
+    SpotifyClient,
+    SpotifyPlayer,
+    create_mqtt_client,
+    get_estimate_publisher,
+    get_poll_offset,
+    get_next_queued_track,
+    record_spotify_request,
+)
+from metrics import STAGE_SECONDS, SCHEDULER_MISFIRES
+from playback import (
+    PlaybackSnapshot,
+    select_cover_url,
+    strip_available_markets,
+)
+
+# Polls that start later than this are counted as misfires, like the default misfire
+# grace time of APScheduler
+MISFIRE_GRACE_TIME = 1
+
+SPOTIFY_API_URL = "https://api.spotify.com/v1/"
+
+
+class AsyncSpotifyClient:
+    """
+    Non-blocking counterpart of the SpotifyClient. The OAuth token is still managed by the
+    SpotifyClient, but API calls and cover downloads go through a shared aiohttp session.
+    """
+
+    def __init__(
+        self,
+        spotify_client: SpotifyClient,
+        session: aiohttp.ClientSession,
+        http_cache: Optional[HttpCache] = None,
+    ):
+        self.spotify_client = spotify_client
+        self.session = session
+        self.http_cache = http_cache
+
+    async def get_access_token(self) -> str:
+        if self.spotify_client.needs_token_refresh():
+            # Reading the cache file and refreshing the token is blocking
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.spotify_client.get_access_token
+            )
+
+        return self.spotify_client.get_access_token()
+
+    async def get(
+        self,
+        name: str,
+        url: str,
+        governed: bool = True,
+        params: Optional[dict] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, bytes]:
+        """
+        Request an url and record the duration and status under the given name
+        :param governed: Whether the request is part of the budget of the client id and its
+        failures back off, False for the cover downloads from the CDN
+        :return: The status and body of the response
+        :raise RequestDeferredError: If the governor holds back the request
+        """
+        governor = self.spotify_client.governor
+        headers = {} if headers is None else headers
+        cache_key = None
+        entry = None
+
+        if self.http_cache is not None:
+            cache_key = get_cache_key(
+                f"{url}?{urlencode(params)}" if params else url,
+                headers.get("Authorization"),
+            )
+            entry = self.http_cache.get(cache_key)
+
+            if entry is not None:
+                if self.http_cache.is_fresh(entry):
+                    return 200, entry.body
+
+                # A 304 is answered from this entry, as it may be evicted during the request
+                headers = {**headers, **self.http_cache.get_validators(entry)}
+
+        if governed:
+            governor.acquire(name)
+
+        with STAGE_SECONDS.time(name):
+            try:
+                async with self.session.get(
+                    url, params=params, headers=headers
+                ) as response:
+                    body = await response.read()
+            except aiohttp.ClientError:
+                record_spotify_request(name, "error")
+                raise
+
+        if governed:
+            governor.on_response(
+                response.status,
+                parse_retry_after(response.headers.get("Retry-After")),
+            )
+
+        if response.status >= 400:
+            record_spotify_request(name, response.status)
+            response.raise_for_status()
+
+        record_spotify_request(name, "ok")
+        status = response.status
+
+        if cache_key is not None:
+            if status == 304 and entry is not None:
+                self.http_cache.record_not_modified()
+                status, body = 200, entry.body
+            elif status == 200:
+                self.http_cache.store(cache_key, response.headers, body)
+
+        return status, body
+
+    async def get_api(self, name: str, endpoint: str, **params) -> Optional[dict]:
+        access_token = await self.get_access_token()
+        status, body = await self.get(
+            name,
+            SPOTIFY_API_URL + endpoint,
+            params=params,
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+
+        if status == 204:
+            return None
+
+        return json.loads(strip_available_markets(body))
+
+    async def current_user_playing_track(self) -> Optional[dict]:
+        return await self.get_api(
+            "playback", "me/player/currently-playing", additional_types="track"
+        )
+
+    async def queue(self) -> Optional[dict]:
+        return await self.get_api("queue", "me/player/queue")
+
+    async def get_cover(self, cover_url: str) -> bytes:
+        return (await self.get("cover", cover_url, governed=False))[1]
+
+
+class MqttAsyncioHelper:
+    """
+    Drives the network loop of a paho client from an asyncio event loop instead of a
+    separate thread and reconnects with a backoff if the connection is lost.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: mqtt.Client):
+        self.loop = loop
+        self.client = client
+        self.logger = get_logger("MqttAsyncioHelper")
+        self.misc_task: Optional[asyncio.Task] = None
+        self.reconnect_task: Optional[asyncio.Task] = None
+
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        client.on_disconnect = self.on_disconnect
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+            self.misc_task = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS and self.reconnect_task is None:
+            self.logger.warning(f"Lost connection to the MQTT broker: {rc}")
+            self.reconnect_task = self.loop.create_task(self.reconnect())
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def connect(self, host: str):
+        """
+        Connect from a task, so the polls do not wait for the broker
+        """
+        self.client.connect_async(host)
+        self.reconnect_task = self.loop.create_task(self.reconnect(0))
+
+    async def reconnect(self, delay: float = 1):
+
+        try:
+            while True:
+                await asyncio.sleep(delay)
+
+                try:
+                    self.client.reconnect()
+                    return
+                except OSError as ex:
+                    self.logger.warning(f"Failed to reconnect to the MQTT broker: {ex}")
+                    delay = min(max(delay * 2, 1), 60)
+        finally:
+            self.reconnect_task = None
+
+
+class AsyncColorScheduler(BaseColorScheduler):
+    """
+    Runtime that drives all players from a single asyncio event loop. Spotify requests and
+    cover downloads are non-blocking, the image analysis runs in worker processes and the
+    MQTT client is integrated into the loop.
+    """
+
+    def __init__(self):
+        super().__init__(
+            create_mqtt_client(),
+            # Only used to refresh the OAuth tokens
+            requests.Session(),
+            call_later=self.call_later,
+            # Analysing in the loop would hold up all requests and MQTT messages
+            inline_executor=ThreadPoolExecutor(1, thread_name_prefix="analysis"),
+        )
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.clients: Dict[str, AsyncSpotifyClient] = {}
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+        self.tasks: Set[asyncio.Task] = set()
+
+    def start(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+
+        http_cache = (
+            HttpCache(Config.HTTP_CACHE_SIZE) if Config.HTTP_CACHE_SIZE > 0 else None
+        )
+
+        async with aiohttp.ClientSession() as session:
+            self.clients = {
+                player.device_id: AsyncSpotifyClient(
+                    player.spotify_client, session, http_cache
+                )
+                for player in self.players
+            }
+
+            MqttAsyncioHelper(self.loop, self.mqttc).connect(Config.MQTT_HOST)
+
+            if Config.HOMIE_STATS:
+                self.start_task(self.publish_stats_periodically())
+
+            if self.transition_streamer is not None:
+                self.start_task(self.stream_transitions())
+
+            await asyncio.gather(
+                *(
+                    self.poll_player(player, get_poll_offset(index, len(self.players)))
+                    for index, player in enumerate(self.players)
+                )
+            )
+
+    async def sleep(self, job: str, delay: float):
+        wake_up_time = self.loop.time() + delay
+        await asyncio.sleep(delay)
+
+        if self.loop.time() - wake_up_time > MISFIRE_GRACE_TIME:
+            SCHEDULER_MISFIRES.inc(job)
+
+    async def publish_stats_periodically(self):
+        while True:
+            await self.sleep("stats_publisher", Config.HOMIE_STATS_INTERVAL)
+            self.publish_stats()
+
+    async def stream_transitions(self):
+        # The MQTT client is driven by the loop, so the frames are published from a task
+        # instead of TransitionStreamer.run
+        while True:
+            self.transition_streamer.publish_frames()
+            await asyncio.sleep(self.transition_streamer.interval)
+
+    async def poll_player(self, player: SpotifyPlayer, offset: float):
+        await asyncio.sleep(offset)
+
+        while True:
+            try:
+                await self.update(player)
+            except RequestDeferredError as ex:
+                self.logger.info(f"Skipped the update of {player.device_id}: {ex}")
+            except aiohttp.ClientResponseError as ex:
+                self.logger.warning(f"Failed to update {player.device_id}: {ex}")
+            except Exception:
+                self.logger.exception(f"Failed to update {player.device_id}")
+
+            await self.sleep("job_updater", self.get_poll_interval(player))
+
+    def call_later(
+        self, delay: float, callback: Callable[[], None]
+    ) -> asyncio.TimerHandle:
+        # The client is driven by the loop, so the delayed publishes have to run in it
+        return self.loop.call_later(delay, callback)
+
+    def set_timer(
+        self,
+        name: str,
+        player: SpotifyPlayer,
+        run_date: datetime,
+        callback: Callable,
+        *args,
+    ):
+        key = f"{name}:{player.device_id}"
+
+        def fire():
+            del self.timers[key]
+            callback(*args)
+
+        self.cancel_timer(name, player)
+        delay = max(0.0, (run_date - self.now()).total_seconds())
+        self.timers[key] = self.loop.call_later(delay, fire)
+
+    def cancel_timer(self, name: str, player: SpotifyPlayer) -> bool:
+        timer = self.timers.pop(f"{name}:{player.device_id}", None)
+
+        if timer is not None:
+            timer.cancel()
+
+        return timer is not None
+
+    def has_timer(self, name: str, player: SpotifyPlayer) -> bool:
+        return f"{name}:{player.device_id}" in self.timers
+
+    def start_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def start_prefetch(self, player: SpotifyPlayer, track_id: str):
+        self.start_task(self.prefetch(player, track_id))
+
+    async def get_cover_analysis(
+        self,
+        key: str,
+        client: AsyncSpotifyClient,
+        album_id: str,
+        cover_url: str,
+        on_estimate: Optional[Callable[[Tuple[int, int, int]], None]] = None,
+    ) -> asyncio.Future:
+        """
+        Look up the analysis of a cover or download the cover and queue its analysis
+        :return: Future of the analysis, its callbacks run in the event loop
+        """
+        future = self.get_cached_analysis(album_id, cover_url)
+
+        if future is None:
+            future = self.analyse_cover(
+                key, album_id, cover_url, await client.get_cover(cover_url), on_estimate
+            )
+
+        return asyncio.wrap_future(future)
+
+    async def prefetch(self, player: SpotifyPlayer, track_id: str):
+        client = self.clients[player.device_id]
+
+        try:
+            next_track = get_next_queued_track(await client.queue())
+
+            if next_track is None:
+                return
+
+            album = next_track["album"]
+            future = await self.get_cover_analysis(
+                f"{player.device_id}:prefetch",
+                client,
+                album["id"],
+                select_cover_url(album["images"], Config.COVER_MIN_SIZE),
+            )
+        except (
+            RequestDeferredError,
+            AnalysisQueueFullError,
+            aiohttp.ClientError,
+        ) as ex:
+            self.logger.warning(f"Failed to prefetch the next track: {ex}")
+            return
+
+        future.add_done_callback(
+            partial(self.set_prefetched_track, player, track_id, next_track)
+        )
+
+    async def update(self, player: SpotifyPlayer):
+        client = self.clients[player.device_id]
+        playback = PlaybackSnapshot.from_response(
+            await client.current_user_playing_track()
+        )
+        received = time.monotonic()
+        cover = self.handle_playback(player, playback, self.now())
+
+        if cover is not None:
+            # Publish once analysed, without holding up the polls. If the track changes
+            # before, the analysis is dropped in favour of the new track.
+            try:
+                future = await self.get_cover_analysis(
+                    player.device_id,
+                    client,
+                    cover.album_id,
+                    cover.cover_url,
+                    on_estimate=get_estimate_publisher(player, playback),
+                )
+            except AnalysisQueueFullError as ex:
+                self.logger.info(f"Deferred the analysis of {player.device_id}: {ex}")
+                player.defer_cover(cover)
+                return
+
+            future.add_done_callback(
+                partial(
+                    self.publish_analysed_track,
+                    player,
+                    cover.track_id,
+                    playback,
+                    received,
+                )
+            )
@@ -0,0 +1,127 @@
+import random
+from io import BytesIO
+from typing import List, NamedTuple, Iterable
+
+from PIL import Image, ImageDraw, ImageFilter
+
+COVER_SIZES = (64, 300, 640)
+COVER_MODES = ("RGB", "L", "P", "RGBA")
+COVER_KINDS = ("blocks", "gradient", "photo")
+
+
+class Cover(NamedTuple):
+    kind: str
+    mode: str
+    size: int
+    image: Image.Image
+
+    @property
+    def name(self) -> str:
+        return f"{self.kind}.{self.mode}.{self.size}"
+
+
+def random_color(rng: random.Random):
+    return rng.randrange(256), rng.randrange(256), rng.randrange(256)
+
+
+def draw_blocks(size: int, rng: random.Random) -> Image.Image:
+    """
+    Flat artwork: a few solid shapes on a solid background
+    """
+    image = Image.new("RGB", (size, size), random_color(rng))
+    draw = ImageDraw.Draw(image)
+
+    for _ in range(12):
+        x0, y0 = rng.randrange(size), rng.randrange(size)
+        x1, y1 = x0 + rng.randrange(1, size), y0 + rng.randrange(1, size)
+
+        if rng.random() < 0.5:
+            draw.rectangle((x0, y0, x1, y1), fill=random_color(rng))
+        else:
+            draw.ellipse((x0, y0, x1, y1), fill=random_color(rng))
+
+    return image
+
+
+def draw_gradient(size: int, rng: random.Random) -> Image.Image:
+    """
+    Smooth diagonal gradient between two colors
+    """
+    mask = Image.linear_gradient("L").rotate(rng.randrange(360)).resize((size, size))
+    return Image.composite(
+        Image.new("RGB", (size, size), random_color(rng)),
+        Image.new("RGB", (size, size), random_color(rng)),
+        mask,
+    )
+
+
+def draw_photo(size: int, rng: random.Random) -> Image.Image:
+    """
+    Photo like image: upscaled random colors with some blur and grain
+    """
+    cells = 8
+    image = Image.frombytes(
+        "RGB", (cells, cells), bytes(rng.randrange(256) for _ in range(cells**2 * 3))
+    )
+    image = image.resize((size, size), Image.BICUBIC)
+    image = image.filter(ImageFilter.GaussianBlur(size / 64))
+    grain = Image.effect_noise((size, size), 24).convert("RGB")
+    return Image.blend(image, grain, 0.1)
+
+
+DRAW_FUNCTIONS = {
+    "blocks": draw_blocks,
+    "gradient": draw_gradient,
+    "photo": draw_photo,
+}
+
+
+def convert(image: Image.Image, mode: str) -> Image.Image:
+    if mode == "RGB":
+        return image
+
+    if mode == "P":
+        return image.convert("P", palette=Image.ADAPTIVE, colors=64)
+
+    if mode == "RGBA":
+        converted = image.convert("RGBA")
+        converted.putalpha(Image.linear_gradient("L").resize(image.size))
+        return converted
+
+    return image.convert(mode)
+
+
+def generate_covers(
+    sizes: Iterable[int] = COVER_SIZES,
+    modes: Iterable[str] = COVER_MODES,
+    kinds: Iterable[str] = COVER_KINDS,
+    seed: int = 0,
+) -> List[Cover]:
+    """
+    Generate a deterministic corpus of album covers
+    :param sizes: Edge lengths of the square covers
+    :param modes: Pillow image modes
+    :param kinds: Kinds of artwork, see DRAW_FUNCTIONS
+    :param seed: Seed of the random generator
+    :return: One cover for every combination of kind, mode and size
+    """
+    rng = random.Random(seed)
+    covers = []
+
+    for kind in kinds:
+        for size in sizes:
+            image = DRAW_FUNCTIONS[kind](size, rng)
+
+            for mode in modes:
+                covers.append(Cover(kind, mode, size, convert(image, mode)))
+
+    return covers
+
+
+def encode_jpeg(image: Image.Image, quality: int = 90) -> bytes:
+    """
+    Encode a cover like the images served by the Spotify CDN
+    """
+    data = BytesIO()
+    image.convert("RGB").save(data, "JPEG", quality=quality)
+    return data.getvalue()
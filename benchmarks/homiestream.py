@@ -0,0 +1,116 @@
+import json
+import random
+import time
+from typing import List, Tuple, Optional
+
+import paho.mqtt.client as mqtt
+
+# Topic, payload and retained flag of a received message
+RecordedMessage = Tuple[str, Optional[str], bool]
+
+VALUES = {
+    "integer": lambda rng: str(rng.randrange(100)),
+    "float": lambda rng: f"{rng.uniform(0, 100):.2f}",
+    "boolean": lambda rng: rng.choice(["true", "false"]),
+    "string": lambda rng: f"value {rng.randrange(1000)}",
+    "enum": lambda rng: rng.choice(["a", "b", "c"]),
+    "color": lambda rng: f"{rng.randrange(256)},{rng.randrange(256)},{rng.randrange(256)}",
+}
+
+
+def generate_stream(
+    device_count: int = 200, value_updates: int = 10, seed: int = 0
+) -> List[RecordedMessage]:
+    """
+    Generate a stream like the one received after subscribing to homie/#: the retained
+    configuration and values of every device, followed by value updates
+    :param device_count: Number of devices
+    :param value_updates: Number of updates of every property after the retained messages
+    :param seed: Seed of the random generator
+    :return: The messages in order of arrival
+    """
+    rng = random.Random(seed)
+    messages = []
+    properties = []
+
+    for device_index in range(device_count):
+        device_topic = f"homie/device-{device_index}"
+        node_ids = [f"node-{index}" for index in range(rng.randint(1, 4))]
+        messages += [
+            (f"{device_topic}/$state", "init", True),
+            (f"{device_topic}/$homie", "4.0.0", True),
+            (f"{device_topic}/$name", f"Device {device_index}", True),
+            (f"{device_topic}/$extensions", "org.homie.legacy-stats:0.1.1:[4.x]", True),
+            (f"{device_topic}/$implementation", "benchmark", True),
+            (f"{device_topic}/$nodes", ",".join(node_ids), True),
+            (f"{device_topic}/$stats/uptime", str(rng.randrange(10000)), True),
+        ]
+
+        for node_id in node_ids:
+            node_topic = f"{device_topic}/{node_id}"
+            property_ids = [f"property-{index}" for index in range(rng.randint(1, 8))]
+            messages += [
+                (f"{node_topic}/$name", node_id.capitalize(), True),
+                (f"{node_topic}/$type", "sensor", True),
+                (f"{node_topic}/$properties", ",".join(property_ids), True),
+            ]
+
+            for property_id in property_ids:
+                property_topic = f"{node_topic}/{property_id}"
+                datatype = rng.choice(list(VALUES))
+                messages += [
+                    (f"{property_topic}/$name", property_id.capitalize(), True),
+                    (f"{property_topic}/$datatype", datatype, True),
+                    (f"{property_topic}/$settable", "false", True),
+                    (f"{property_topic}/$retained", "true", True),
+                    (f"{property_topic}/$unit", "u", True),
+                    (property_topic, VALUES[datatype](rng), True),
+                ]
+                properties.append((property_topic, datatype))
+
+        messages.append((f"{device_topic}/$state", "ready", True))
+
+    for _ in range(value_updates):
+        for property_topic, datatype in rng.sample(properties, len(properties)):
+            messages.append((property_topic, VALUES[datatype](rng), False))
+
+    return messages
+
+
+def load_stream(path: str) -> List[RecordedMessage]:
+    """
+    Load a stream recorded with record_stream, one JSON object per line
+    """
+    with open(path) as file:
+        return [
+            (message["topic"], message["payload"], message["retained"])
+            for message in map(json.loads, file)
+        ]
+
+
+def record_stream(host: str, path: str, duration: float, port: int = 1883):
+    """
+    Record the messages below homie/# of a broker for duration seconds
+    """
+    with open(path, "w") as file:
+
+        def on_connect(client, userdata, flags, rc):
+            client.subscribe("homie/#")
+
+        def on_message(client, userdata, message: mqtt.MQTTMessage):
+            payload = message.payload.decode("utf-8") if message.payload else None
+            record = {
+                "topic": message.topic,
+                "payload": payload,
+                "retained": bool(message.retain),
+            }
+            file.write(json.dumps(record) + "\n")
+
+        client = mqtt.Client()
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.connect(host, port)
+        client.loop_start()
+        time.sleep(duration)
+        client.loop_stop()
+        client.disconnect()
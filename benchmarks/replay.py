@@ -0,0 +1,613 @@
+import bisect
+import heapq
+import itertools
+import json
+import random
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Tuple, Optional, List, Dict, Callable, Any
+
+import click
+import requests
+from apscheduler.jobstores.base import JobLookupError
+
+from benchmarks.corpus import generate_covers, encode_jpeg
+from benchmarks.run import FakeMessageInfo, get_percentile
+from config import Config
+from logger import get_logger
+from main import ColorScheduler, SpotifyAccount, SpotifyClient
+from metrics import ANALYSIS_CACHE_LOOKUPS
+from statestore import StateStore, PlayerState
+
+# Seconds since the start of the session and the currently playing response, None while
+# nothing is playing
+PlaybackSample = Tuple[float, Optional[dict]]
+
+START_TIME = datetime(2024, 1, 1)
+DEVICE_ID = "spotibridge"
+
+
+class VirtualClock:
+    def __init__(self, start: datetime = START_TIME):
+        self.start = start
+        self.time = start
+
+    def now(self) -> datetime:
+        return self.time
+
+    def get_seconds(self) -> float:
+        return (self.time - self.start).total_seconds()
+
+
+class VirtualJob:
+    def __init__(
+        self,
+        scheduler: "VirtualScheduler",
+        job_id: str,
+        function: Callable,
+        args: tuple,
+        interval: Optional[timedelta],
+    ):
+        self.scheduler = scheduler
+        self.id = job_id
+        self.function = function
+        self.args = args
+        self.interval = interval
+
+    def remove(self):
+        self.scheduler.remove_job(self.id)
+
+
+class VirtualScheduler:
+    """
+    Runs jobs in virtual time with the part of the APScheduler interface used by the
+    ColorScheduler. The clock jumps from one run date to the next, so jobs never misfire.
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self.jobs: Dict[str, VirtualJob] = {}
+        self.queue: List[Tuple[datetime, int, VirtualJob]] = []
+        self.sequence = itertools.count()
+        self.logger = get_logger("VirtualScheduler")
+
+    def add_job(
+        self,
+        function: Callable,
+        trigger: str,
+        args: tuple = (),
+        id: Optional[str] = None,
+        run_date: Optional[datetime] = None,
+        seconds: float = 0,
+        start_date: Optional[datetime] = None,
+        replace_existing: bool = False,
+        **kwargs,
+    ) -> VirtualJob:
+        job_id = id if id is not None else f"job-{next(self.sequence)}"
+
+        if job_id in self.jobs and not replace_existing:
+            raise ValueError(f"Job {job_id} already exists")
+
+        if trigger == "interval":
+            interval = timedelta(seconds=seconds)
+            run_date = start_date if start_date is not None else self.clock.now()
+        else:
+            interval = None
+            run_date = run_date if run_date is not None else self.clock.now()
+
+        job = VirtualJob(self, job_id, function, args, interval)
+        self.jobs[job_id] = job
+        heapq.heappush(self.queue, (run_date, next(self.sequence), job))
+        return job
+
+    def get_job(self, job_id: str) -> Optional[VirtualJob]:
+        return self.jobs.get(job_id)
+
+    def remove_job(self, job_id: str):
+        if self.jobs.pop(job_id, None) is None:
+            raise JobLookupError(job_id)
+
+    def add_listener(self, callback: Callable, mask: int = 0):
+        pass
+
+    def run_until(self, end: datetime):
+        while self.queue and self.queue[0][0] <= end:
+            run_date, _, job = heapq.heappop(self.queue)
+
+            if self.jobs.get(job.id) is not job:
+                # Removed or replaced
+                continue
+
+            self.clock.time = max(self.clock.time, run_date)
+
+            if job.interval is None:
+                del self.jobs[job.id]
+            else:
+                heapq.heappush(
+                    self.queue, (run_date + job.interval, next(self.sequence), job)
+                )
+
+            try:
+                job.function(*job.args)
+            except Exception:
+                self.logger.exception(f"Job {job.id} raised an exception")
+
+        self.clock.time = end
+
+
+class FakeBroker:
+    """
+    In-process stand-in for the paho client that keeps every message with its virtual time
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self.mid = 0
+        self.messages: List[Tuple[datetime, str, Optional[str]]] = []
+        self.on_connect = None
+        self.on_publish = None
+
+    def connect_async(self, host: str, *args, **kwargs):
+        pass
+
+    def loop_start(self):
+        # Connected right away, instead of by the network thread
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.mid += 1
+        self.messages.append((self.clock.now(), topic, payload))
+        return FakeMessageInfo(self.mid)
+
+
+class PlaybackTimeline:
+    """
+    Answers the Spotify API from recorded playback samples at any point of the session
+    """
+
+    def __init__(self, samples: List[PlaybackSample]):
+        self.times = [sample[0] for sample in samples]
+        self.payloads = [sample[1] for sample in samples]
+        # Covers are looked up by album, whatever their recorded url is
+        self.album_ids = {
+            image["url"]: payload["item"]["album"]["id"]
+            for payload in self.payloads
+            if payload is not None
+            for image in payload["item"]["album"]["images"]
+        }
+
+    def get_index(self, seconds: float) -> int:
+        return bisect.bisect_right(self.times, seconds) - 1
+
+    def get_playback(self, seconds: float) -> Optional[dict]:
+        index = self.get_index(seconds)
+
+        if index < 0 or self.payloads[index] is None:
+            return None
+
+        payload = self.payloads[index]
+
+        if not payload["is_playing"]:
+            return payload
+
+        progress = payload["progress_ms"] + int((seconds - self.times[index]) * 1000)
+        return {
+            **payload,
+            "progress_ms": min(progress, payload["item"]["duration_ms"]),
+        }
+
+    def get_queue(self, seconds: float) -> dict:
+        index = self.get_index(seconds)
+        current = self.payloads[index] if index >= 0 else None
+        current_id = current["item"]["id"] if current is not None else None
+
+        for payload in self.payloads[index + 1 :]:
+            if payload is not None and payload["item"]["id"] != current_id:
+                return {"queue": [payload["item"]]}
+
+        return {"queue": []}
+
+    def get_track_starts(self) -> List[Tuple[float, dict]]:
+        """
+        :return: The time every track started and its item
+        """
+        starts = []
+        previous_id = None
+
+        for sample_time, payload in zip(self.times, self.payloads):
+            if payload is None:
+                previous_id = None
+                continue
+
+            if payload["item"]["id"] != previous_id and payload["is_playing"]:
+                starts.append(
+                    (sample_time - payload["progress_ms"] / 1000, payload["item"])
+                )
+
+            previous_id = payload["item"]["id"]
+
+        return starts
+
+
+class CoverSource:
+    """
+    Covers by album id, read from <album id>.jpg or .png in a directory or generated
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = Path(directory) if directory is not None else None
+        self.covers: Dict[str, bytes] = {}
+        self.generated: Optional[List[bytes]] = None
+
+    def get(self, album_id: str) -> bytes:
+        if album_id not in self.covers:
+            self.covers[album_id] = self.load(album_id)
+
+        return self.covers[album_id]
+
+    def load(self, album_id: str) -> bytes:
+        if self.directory is not None:
+            for suffix in (".jpg", ".png"):
+                path = self.directory / f"{album_id}{suffix}"
+
+                if path.exists():
+                    return path.read_bytes()
+
+        if self.generated is None:
+            self.generated = [
+                encode_jpeg(cover.image)
+                for cover in generate_covers()
+                if cover.mode == "RGB" and cover.size == 640
+            ]
+
+        return self.generated[zlib.crc32(album_id.encode()) % len(self.generated)]
+
+
+class ReplaySpotifyClient:
+    """
+    Serves the Spotify calls of a player from a timeline and counts them
+    """
+
+    def __init__(
+        self,
+        timeline: PlaybackTimeline,
+        clock: VirtualClock,
+        covers: CoverSource,
+        calls: Dict[str, int],
+    ):
+        self.timeline = timeline
+        self.clock = clock
+        self.covers = covers
+        self.calls = calls
+
+    def count(self, endpoint: str):
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def current_user_playing_track(self) -> Optional[dict]:
+        self.count("playback")
+        return self.timeline.get_playback(self.clock.get_seconds())
+
+    def queue(self) -> Optional[dict]:
+        self.count("queue")
+        return self.timeline.get_queue(self.clock.get_seconds())
+
+    def get_cover(self, cover_url: str) -> bytes:
+        self.count("cover")
+        return self.covers.get(self.timeline.album_ids.get(cover_url, cover_url))
+
+
+def create_item(index: int, album_id: str, duration_ms: int) -> dict:
+    return {
+        "id": f"track-{index}",
+        "name": f"Track {index}",
+        "type": "track",
+        "duration_ms": duration_ms,
+        "album": {
+            "id": album_id,
+            "images": [{"url": f"replay:{album_id}", "width": 640, "height": 640}],
+        },
+    }
+
+
+def generate_session(
+    hours: float = 4, album_count: int = 50, seed: int = 0
+) -> List[PlaybackSample]:
+    """
+    Generate a listening session with skipped tracks, pauses and albums played repeatedly
+    :param hours: Length of the session
+    :param album_count: Number of distinct albums, i.e. covers
+    :param seed: Seed of the random generator
+    :return: A sample at every change of the playback
+    """
+    rng = random.Random(seed)
+    samples: List[PlaybackSample] = []
+    seconds = 0.0
+    index = 0
+
+    while seconds < hours * 3600:
+        if rng.random() < 0.03:
+            samples.append((seconds, None))
+            seconds += rng.uniform(60, 900)
+            continue
+
+        duration_ms = rng.randint(120, 330) * 1000
+        item = create_item(index, f"album-{rng.randrange(album_count)}", duration_ms)
+        index += 1
+        samples.append((seconds, {"is_playing": True, "progress_ms": 0, "item": item}))
+
+        if rng.random() < 0.15:
+            # Skipped
+            seconds += rng.uniform(3, 60)
+        else:
+            seconds += duration_ms / 1000
+
+    samples.append((seconds, None))
+    return samples
+
+
+def load_session(path: str) -> List[PlaybackSample]:
+    """
+    Load a session recorded by record_session, one JSON object with "time" and "playback"
+    per line
+    """
+    with open(path) as file:
+        return [
+            (entry["time"], entry["playback"])
+            for entry in (json.loads(line) for line in file if line.strip())
+        ]
+
+
+def record_session(path: str, username: str, duration: float, interval: float):
+    """
+    Record the playback of a Spotify account, whenever the playing track changes or is
+    paused or resumed
+    """
+    client = SpotifyClient(username, requests.Session())
+    start = time.monotonic()
+    previous_state = ()
+
+    with open(path, "w") as file:
+        while time.monotonic() - start < duration:
+            playback = client.current_user_playing_track()
+
+            if playback is not None and playback.get("item") is None:
+                playback = None
+
+            state = (
+                None
+                if playback is None
+                else (playback["item"]["id"], playback["is_playing"])
+            )
+
+            if state != previous_state:
+                entry = {"time": time.monotonic() - start, "playback": playback}
+                file.write(json.dumps(entry) + "\n")
+                file.flush()
+                previous_state = state
+
+            time.sleep(interval)
+
+
+def get_latencies(
+    timeline: PlaybackTimeline, messages: List[Tuple[datetime, str, Optional[str]]]
+) -> Tuple[List[float], int]:
+    """
+    Measure the time from the start of every track until its title has been published
+    :return: The latencies in seconds and the number of tracks that were never published
+    """
+    topic = f"homie/{DEVICE_ID}/player/track"
+    titles = [
+        ((sent - START_TIME).total_seconds(), payload)
+        for sent, message_topic, payload in messages
+        if message_topic == topic
+    ]
+    track_starts = timeline.get_track_starts()
+    latencies = []
+    missed = 0
+
+    for index, (start, item) in enumerate(track_starts):
+        end = track_starts[index + 1][0] if index + 1 < len(track_starts) else None
+        published = next(
+            (
+                sent
+                for sent, title in titles
+                if title == item["name"]
+                and sent >= start
+                and (end is None or sent < end)
+            ),
+            None,
+        )
+
+        if published is None:
+            missed += 1
+        else:
+            latencies.append(published - start)
+
+    return latencies, missed
+
+
+def get_published_values(
+    messages: List[Tuple[datetime, str, Optional[str]]]
+) -> Dict[str, Optional[str]]:
+    """
+    :return: The last published value of every property of the player node
+    """
+    values = {}
+
+    for _, topic, payload in messages:
+        levels = topic.split("/")
+
+        if levels[:3] == ["homie", DEVICE_ID, "player"] and len(levels) == 4:
+            if not levels[3].startswith("$"):
+                values[levels[3]] = payload
+
+    return values
+
+
+def replay(samples: List[PlaybackSample], covers: CoverSource) -> Dict[str, Any]:
+    """
+    Run a session through the ColorScheduler in virtual time
+    :return: The report
+    """
+    clock = VirtualClock()
+    scheduler = VirtualScheduler(clock)
+    broker = FakeBroker(clock)
+    timeline = PlaybackTimeline(samples)
+    calls: Dict[str, int] = {}
+    cache_lookups = {
+        result: ANALYSIS_CACHE_LOOKUPS.get(result)
+        for result in ("memory", "disk", "miss")
+    }
+
+    started = time.perf_counter()
+    ColorScheduler(
+        scheduler,
+        broker,
+        [SpotifyAccount("replay", DEVICE_ID, "Spotibridge")],
+        lambda username, session: ReplaySpotifyClient(timeline, clock, covers, calls),
+        clock.now,
+    )
+    end = samples[-1][0] + 60
+    scheduler.run_until(clock.start + timedelta(seconds=end))
+    wall_seconds = time.perf_counter() - started
+
+    latencies, missed = get_latencies(timeline, broker.messages)
+    latencies.sort()
+
+    return {
+        "simulated_seconds": end,
+        "wall_seconds": wall_seconds,
+        "tracks": len(latencies) + missed,
+        "latency": {
+            "mean_s": sum(latencies) / len(latencies) if latencies else None,
+            "p50_s": get_percentile(latencies, 50) if latencies else None,
+            "p95_s": get_percentile(latencies, 95) if latencies else None,
+            "max_s": latencies[-1] if latencies else None,
+            "missed_tracks": missed,
+        },
+        "api_calls": calls,
+        "analysis_cache": {
+            result: ANALYSIS_CACHE_LOOKUPS.get(result) - count
+            for result, count in cache_lookups.items()
+        },
+        "mqtt_messages": len(broker.messages),
+        "published": get_published_values(broker.messages),
+    }
+
+
+def configure_replay():
+    # Deterministic and self-contained, everything else is taken from the environment
+    Config.ANALYSIS_WORKERS = 0
+    Config.ANALYSIS_CACHE_PATH = None
+    Config.STATE_SNAPSHOT_PATH = None
+    Config.HOMIE_STATS = False
+    Config.TRANSITION_STREAM = False
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--session", type=click.Path(exists=True), help="Recorded session")
+@click.option("--hours", default=4.0, help="Length of a generated session")
+@click.option("--seed", default=0, help="Seed of a generated session")
+@click.option("--covers", type=click.Path(exists=True), help="<album id>.jpg covers")
+@click.option("--poll-mode", type=click.Choice(["fixed", "adaptive"]))
+@click.option("--poll-interval", type=float)
+@click.option("--prefetch/--no-prefetch", default=None)
+@click.option("--cache-size", type=int, help="Analyses kept in memory")
+@click.option("--output", type=click.Path(), help="Write the report to this file")
+def run(
+    session,
+    hours,
+    seed,
+    covers,
+    poll_mode,
+    poll_interval,
+    prefetch,
+    cache_size,
+    output,
+):
+    """
+    Replay a listening session through the scheduling, analysis and publishing logic in
+    virtual time and report the delay of the track changes and the API calls
+    """
+    configure_replay()
+
+    if poll_mode is not None:
+        Config.POLL_MODE = poll_mode
+
+    if poll_interval is not None:
+        Config.POLL_INTERVAL = poll_interval
+
+    if prefetch is not None:
+        Config.PREFETCH = prefetch
+
+    if cache_size is not None:
+        Config.ANALYSIS_CACHE_MEMORY_SIZE = cache_size
+
+    samples = load_session(session) if session else generate_session(hours, seed=seed)
+    report = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": sys.version,
+            "session": session or f"generated, {hours} hours, seed {seed}",
+            "poll_mode": Config.POLL_MODE,
+            "poll_interval": Config.POLL_INTERVAL,
+            "prefetch": Config.PREFETCH,
+            "cache_size": Config.ANALYSIS_CACHE_MEMORY_SIZE,
+        },
+        **replay(samples, CoverSource(covers)),
+    }
+    report_json = json.dumps(report, indent=2)
+
+    if output:
+        with open(output, "w") as file:
+            file.write(report_json)
+    else:
+        click.echo(report_json)
+
+
+@cli.command()
+@click.option("--seconds", default=60.0, help="Seconds to run after the restart")
+def restart(seconds):
+    """
+    Restart the bridge from a snapshot of a playing track while nothing is playing and
+    report the published values, which fails if the restored track is still published
+    """
+    configure_replay()
+    state = PlayerState("track-0", "Track 0", True, (255, 0, 0), [(255, 0, 0)])
+
+    with tempfile.TemporaryDirectory() as directory:
+        Config.STATE_SNAPSHOT_PATH = str(Path(directory) / "state.json")
+        StateStore(Config.STATE_SNAPSHOT_PATH).put(DEVICE_ID, state)
+        report = replay([(0.0, None), (seconds, None)], CoverSource())
+
+    click.echo(json.dumps(report, indent=2))
+    published = report["published"]
+
+    if published.get("is-playing") != "false" or published.get("track") != "":
+        raise click.ClickException("The restored playing state was not cleared")
+
+
+@cli.command()
+@click.argument("path", type=click.Path())
+@click.option("--username", default=lambda: Config.SPOTIFY_USERNAME)
+@click.option("--duration", default=3600.0, help="Seconds to record")
+@click.option("--interval", default=1.0, help="Seconds between polls")
+def record(path, username, duration, interval):
+    """
+    Record the playback of a Spotify account for replaying it with --session
+    """
+    record_session(path, username, duration, interval)
+
+
+if __name__ == "__main__":
+    cli()
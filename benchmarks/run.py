@@ -0,0 +1,311 @@
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Tuple, Sequence, Any, Dict, List
+
+import click
+import numpy
+import PIL
+
+from benchmarks.corpus import (
+    generate_covers,
+    encode_jpeg,
+    COVER_SIZES,
+    COVER_MODES,
+    Cover,
+)
+from benchmarks.homiestream import (
+    generate_stream,
+    load_stream,
+    record_stream,
+    RecordedMessage,
+)
+from colorfinder import ColorFinder, color_filter_hue_brightness
+from homie import HomieManager, HomiePublisher, HomieDevice
+from coveranalyser import CoverAnalyser
+
+# Returns the operation and the argument tuples it is called with, one call per argument
+Setup = Callable[[], Tuple[Callable[..., Any], Sequence[Tuple]]]
+
+
+class FakeMessageInfo:
+    rc = 0
+
+    def __init__(self, mid: int):
+        self.mid = mid
+
+    @staticmethod
+    def is_published() -> bool:
+        return True
+
+
+class FakeMqttClient:
+    """
+    Acknowledges every message right away, so only the cost of the callers is measured
+    """
+
+    def __init__(self):
+        self.mid = 0
+        self.message_count = 0
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.mid += 1
+        self.message_count += 1
+        return FakeMessageInfo(self.mid)
+
+
+def get_percentile(sorted_values: List[int], percentile: float) -> int:
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))
+    return sorted_values[index]
+
+
+def measure(setup: Setup, repeat: int) -> Dict[str, Any]:
+    """
+    Time every single call of an operation. The first run is a warm up, the peak memory
+    is traced in an additional run, as tracing slows down the operation.
+    :param setup: Prepares a fresh state for every run, not included in the timings
+    :param repeat: Number of timed runs
+    :return: The statistics of the calls
+    """
+    operation, arguments = setup()
+
+    for argument in arguments:
+        operation(*argument)
+
+    latencies = []
+
+    for _ in range(repeat):
+        operation, arguments = setup()
+
+        for argument in arguments:
+            start = time.perf_counter_ns()
+            operation(*argument)
+            latencies.append(time.perf_counter_ns() - start)
+
+    operation, arguments = setup()
+    tracemalloc.start()
+
+    try:
+        for argument in arguments:
+            operation(*argument)
+
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    total = sum(latencies)
+
+    return {
+        "operations": len(latencies),
+        "throughput": len(latencies) / (total / 1e9) if total > 0 else None,
+        "p50_us": get_percentile(latencies, 50) / 1e3,
+        "p99_us": get_percentile(latencies, 99) / 1e3,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def get_color_benchmarks(covers: List[Cover]) -> Dict[str, Setup]:
+    analyser = CoverAnalyser()
+    color_finders = {
+        "color": analyser.color_finder,
+        "color-pure": ColorFinder(color_filter_hue_brightness),
+    }
+    benchmarks = {}
+
+    for mode in COVER_MODES:
+        for size in COVER_SIZES:
+            images = [
+                (cover.image,)
+                for cover in covers
+                if cover.mode == mode and cover.size == size
+            ]
+
+            if not images:
+                continue
+
+            for name, color_finder in color_finders.items():
+                if name == "color-pure" and mode != "RGB":
+                    # Reads the pixels as RGB tuples
+                    continue
+
+                benchmarks[f"{name}.{mode}.{size}"] = lambda c=color_finder, i=images: (
+                    c.get_most_prominent_color,
+                    i,
+                )
+
+            benchmarks[f"palette.{mode}.{size}"] = lambda i=images: (
+                analyser.get_color_palette,
+                i,
+            )
+
+    for size in COVER_SIZES:
+        data = [
+            (encode_jpeg(cover.image),)
+            for cover in covers
+            if cover.mode == "RGB" and cover.size == size
+        ]
+
+        if data:
+            benchmarks[f"analyse.jpeg.{size}"] = lambda d=data: (analyser.analyse, d)
+
+    return benchmarks
+
+
+def get_homie_benchmarks(stream: List[RecordedMessage]) -> Dict[str, Setup]:
+    value_messages = [message for message in stream if not message[2]]
+
+    def create_manager() -> HomieManager:
+        # Validate right away instead of from a timer thread
+        return HomieManager(FakeMqttClient(), validation_delay=0)
+
+    def create_discovered_manager() -> HomieManager:
+        manager = create_manager()
+        manager.on_homie_messages(stream)
+        return manager
+
+    def setup_discovery():
+        return create_manager().on_homie_message, stream
+
+    def setup_values():
+        return create_discovered_manager().on_homie_message, value_messages
+
+    def setup_replay():
+        return create_discovered_manager().on_homie_message, stream
+
+    def get_valid_devices(mqtt_client: FakeMqttClient) -> List[HomieDevice]:
+        devices = list(create_discovered_manager().homie_devices.values())
+        publisher = HomiePublisher(mqtt_client)
+
+        for device in devices:
+            device.publisher = publisher
+
+        return [device for device in devices if device.is_valid]
+
+    # The publisher references the client weakly, so the operations keep it alive
+
+    def setup_publish_config():
+        mqtt_client = FakeMqttClient()
+        devices = [(device,) for device in get_valid_devices(mqtt_client)]
+        return lambda device, client=mqtt_client: device.publish_config(True), devices
+
+    def setup_publish_values():
+        mqtt_client = FakeMqttClient()
+        properties = [
+            (homie_property,)
+            for device in get_valid_devices(mqtt_client)
+            for node in device.nodes.values()
+            for homie_property in node.properties.values()
+        ]
+        return lambda prop, client=mqtt_client: prop.publish_value(), properties
+
+    return {
+        "homie.ingest.discovery": setup_discovery,
+        "homie.ingest.values": setup_values,
+        "homie.ingest.replay": setup_replay,
+        "homie.publish.config": setup_publish_config,
+        "homie.publish.values": setup_publish_values,
+    }
+
+
+def find_regressions(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    tolerance: float,
+) -> List[str]:
+    regressions = []
+
+    for name, result in results.items():
+        previous = baseline.get(name)
+
+        if previous is None:
+            continue
+
+        for key in ("p50_us", "p99_us", "peak_memory_bytes"):
+            if previous[key] and result[key] > previous[key] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: {key} increased from {previous[key]} to {result[key]}"
+                )
+
+    return regressions
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--repeat", default=5, help="Number of timed runs per benchmark")
+@click.option(
+    "--filter", "name_filter", default="", help="Only run matching benchmarks"
+)
+@click.option("--homie-stream", type=click.Path(exists=True), help="Recorded stream")
+@click.option("--output", type=click.Path(), help="Write the results to this file")
+@click.option("--baseline", type=click.Path(exists=True), help="Results to compare to")
+@click.option("--tolerance", default=0.2, help="Allowed relative slowdown")
+def run(repeat, name_filter, homie_stream, output, baseline, tolerance):
+    """
+    Run the benchmarks and emit the results as JSON
+    """
+    stream = load_stream(homie_stream) if homie_stream else generate_stream()
+    benchmarks = {
+        **get_color_benchmarks(generate_covers()),
+        **get_homie_benchmarks(stream),
+    }
+    results = {}
+
+    for name, setup in benchmarks.items():
+        if name_filter in name:
+            click.echo(f"Running {name}", err=True)
+            results[name] = measure(setup, repeat)
+
+    report = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "numpy": numpy.__version__,
+            "pillow": PIL.__version__,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=2)
+
+    if output:
+        with open(output, "w") as file:
+            file.write(report_json)
+    else:
+        click.echo(report_json)
+
+    if baseline:
+        with open(baseline) as file:
+            regressions = find_regressions(
+                results, json.load(file)["results"], tolerance
+            )
+
+        for regression in regressions:
+            click.echo(f"Regression: {regression}", err=True)
+
+        if regressions:
+            sys.exit(1)
+
+
+@cli.command()
+@click.argument("path", type=click.Path())
+@click.option("--host", default="localhost")
+@click.option("--port", default=1883)
+@click.option("--duration", default=10.0, help="Seconds to record")
+def record(path, host, port, duration):
+    """
+    Record the homie messages of a broker for replaying them with --homie-stream
+    """
+    record_stream(host, path, duration, port)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,5 +1,8 @@
+from functools import lru_cache
 from math import sqrt
 
+import numpy
+
 
 def color_filter_hue(r, g, b):
     return (
@@ -23,9 +26,115 @@ def color_filter_hue_brightness(r, g, b):
     ) * sqrt(v)
 
 
+def color_filter_hue_array(r, g, b):
+    return (
+        numpy.abs(r - g) * numpy.abs(r - g)
+        + numpy.abs(r - b) * numpy.abs(r - b)
+        + numpy.abs(g - b) * numpy.abs(g - b)
+    ) / 65535 * 50 + 1
+
+
+def color_filter_hue_brightness_array(r, g, b):
+    v = numpy.maximum(numpy.maximum(r / 255, g / 255), b / 255)
+    return (
+        (
+            (
+                numpy.abs(r - g) * numpy.abs(r - g)
+                + numpy.abs(r - b) * numpy.abs(r - b)
+                + numpy.abs(g - b) * numpy.abs(g - b)
+            )
+            / 65535
+            * 50
+        )
+        + 1
+    ) * numpy.sqrt(v)
+
+
+def color_filter_hsv_array(r, g, b):
+    maximum = numpy.maximum(numpy.maximum(r, g), b)
+    minimum = numpy.minimum(numpy.minimum(r, g), b)
+    saturation = (maximum - minimum) / numpy.maximum(maximum, 1)
+    return (saturation * 50 + 1) * numpy.sqrt(maximum / 255)
+
+
+def srgb_to_linear(c):
+    c = c / 255
+    return numpy.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+
+
+def rgb_to_oklab(r, g, b):
+    r, g, b = srgb_to_linear(r), srgb_to_linear(g), srgb_to_linear(b)
+    l = numpy.cbrt(0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b)
+    m = numpy.cbrt(0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b)
+    s = numpy.cbrt(0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b)
+    return (
+        0.2104542553 * l + 0.7936177850 * m - 0.0040720468 * s,
+        1.9779984951 * l - 2.4285922050 * m + 0.4505937099 * s,
+        0.0259040371 * l + 0.7827717662 * m - 0.8086757660 * s,
+    )
+
+
+# Highest chroma of an sRGB color in OKLab, reached by pure blue
+OKLAB_MAX_CHROMA = 0.3225
+
+
+def color_filter_oklab_array(r, g, b):
+    lightness, a, b = rgb_to_oklab(r, g, b)
+    chroma = numpy.sqrt(a * a + b * b)
+    return (chroma / OKLAB_MAX_CHROMA * 50 + 1) * lightness
+
+
+# Vectorized counterparts of the scalar color filters, operating on int64 arrays
+ARRAY_COLOR_FILTERS = {
+    color_filter_hue: color_filter_hue_array,
+    color_filter_hue_brightness: color_filter_hue_brightness_array,
+}
+
+# Filters selectable by name, the perceptual ones only exist in vectorized form
+NAMED_ARRAY_COLOR_FILTERS = {
+    "hue": color_filter_hue_array,
+    "hue-brightness": color_filter_hue_brightness_array,
+    "hsv": color_filter_hsv_array,
+    "oklab": color_filter_oklab_array,
+}
+
+
+class ColorFilterTable:
+    """
+    A color filter evaluated once for every color with 5 bits per channel. Applying it is
+    a table lookup, no matter how expensive the filter is, and works on scalars as well as
+    on int64 arrays.
+    """
+
+    def __init__(self, array_filter):
+        # Evaluate every cell at its center
+        levels = numpy.arange(32, dtype=numpy.int64) << 3 | 4
+        r, g, b = numpy.meshgrid(levels, levels, levels, indexing="ij")
+        self.table = numpy.asarray(
+            array_filter(r.reshape(-1), g.reshape(-1), b.reshape(-1)),
+            dtype=numpy.float64,
+        )
+
+    def __call__(self, r, g, b):
+        return self.table[(r >> 3) << 10 | (g >> 3) << 5 | b >> 3]
+
+
+@lru_cache(maxsize=None)
+def get_color_filter(name: str) -> ColorFilterTable:
+    """
+    :param name: One of NAMED_ARRAY_COLOR_FILTERS
+    :return: The lookup table of the filter, shared by all callers
+    """
+    if name not in NAMED_ARRAY_COLOR_FILTERS:
+        raise ValueError(f"Unknown color filter {name}")
+
+    return ColorFilterTable(NAMED_ARRAY_COLOR_FILTERS[name])
+
+
 class ColorFinder:
-    def __init__(self, color_filter):
+    def __init__(self, color_filter, sample_count=1250):
         self.color_filter = color_filter
+        self.sample_count = sample_count
 
     def get_most_prominent_color(self, image):
         rgb = None
@@ -74,7 +183,7 @@ class ColorFinder:
     def get_image_data(self, image):
         result = dict()
         length = image.width * image.height
-        factor = max(1, round(length / 1250.0))
+        factor = max(1, round(length / float(self.sample_count)))
 
         for idx in range(0, length, factor):
             r, g, b = image.getpixel((int(idx / image.width), idx % image.width))
@@ -92,3 +201,117 @@ class ColorFinder:
                 result[key]["count"] += 1
 
         return result
+
+
+class NumpyColorFinder(ColorFinder):
+    """
+    Array-backed variant of the ColorFinder. The sampled pixels are pulled out of a
+    single buffer and every degrade level is accumulated with bincount, while the
+    results stay identical to the pure python implementation.
+    """
+
+    def get_most_prominent_color(self, image):
+        rgb = None
+        colors, weights = self.get_image_array(image)
+
+        for degrade in (6, 4, 2, 0):
+            rgb = self.get_most_prominent_rgb_array(colors, weights, degrade, rgb)
+
+        return rgb["r"], rgb["g"], rgb["b"]
+
+    def get_estimated_color(self, image):
+        """
+        Cheap estimate of the most prominent color, from the coarsest degrade level only
+        :return: The weighted mean of the samples in the most prominent coarse group
+        """
+        colors, weights = self.get_image_array(image)
+        r, g, b = colors
+        rgb = self.get_most_prominent_rgb_array(colors, weights, 6, None)
+        mask = ((r >> 6) == rgb["r"]) & ((g >> 6) == rgb["g"]) & ((b >> 6) == rgb["b"])
+
+        return tuple(
+            int(round(numpy.average(channel[mask], weights=weights[mask])))
+            for channel in colors
+        )
+
+    def get_most_prominent_rgb_array(self, colors, weights, degrade, rgb_match):
+        r, g, b = colors
+
+        if rgb_match is not None:
+            match_degrade = rgb_match["degrade"]
+            mask = (
+                ((r >> match_degrade) == rgb_match["r"])
+                & ((g >> match_degrade) == rgb_match["g"])
+                & ((b >> match_degrade) == rgb_match["b"])
+            )
+            r, g, b, weights = r[mask], g[mask], b[mask], weights[mask]
+
+        group_keys = (r >> degrade) << 16 | (g >> degrade) << 8 | b >> degrade
+        groups, first_index, inverse = numpy.unique(
+            group_keys, return_index=True, return_inverse=True
+        )
+        group_weights = numpy.bincount(inverse.reshape(-1), weights=weights)
+
+        # Ties are resolved in favor of the group that occurred first in the image
+        candidates = numpy.flatnonzero(group_weights == group_weights.max())
+        best = candidates[numpy.argmin(first_index[candidates])]
+        key = int(groups[best])
+
+        return dict(
+            r=key >> 16,
+            g=(key >> 8) & 0xFF,
+            b=key & 0xFF,
+            count=float(group_weights[best]),
+            degrade=degrade,
+        )
+
+    def get_image_array(self, image):
+        """
+        Sample the image like get_image_data does and reduce the samples to unique colors
+        :param image: The image to analyse
+        :return: The r, g and b arrays of the unique colors in order of their first
+        occurrence and the total weight of each color
+        """
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        pixels = numpy.frombuffer(image.tobytes(), dtype=numpy.uint8).reshape(
+            image.height, image.width, 3
+        )
+        length = image.width * image.height
+        factor = max(1, round(length / float(self.sample_count)))
+        idx = numpy.arange(0, length, factor)
+        samples = pixels[idx % image.width, idx // image.width].astype(numpy.int64)
+
+        keys = samples[:, 0] << 16 | samples[:, 1] << 8 | samples[:, 2]
+        unique_keys, first_index, counts = numpy.unique(
+            keys, return_index=True, return_counts=True
+        )
+        order = numpy.argsort(first_index, kind="stable")
+        unique_keys = unique_keys[order]
+        counts = counts[order]
+
+        r = unique_keys >> 16
+        g = (unique_keys >> 8) & 0xFF
+        b = unique_keys & 0xFF
+
+        if isinstance(self.color_filter, ColorFilterTable):
+            array_filter = self.color_filter
+        else:
+            array_filter = ARRAY_COLOR_FILTERS.get(self.color_filter)
+
+        if array_filter is not None:
+            weights = array_filter(r, g, b).astype(numpy.float64)
+        else:
+            weights = numpy.fromiter(
+                (
+                    self.color_filter(int(cr), int(cg), int(cb))
+                    for cr, cg, cb in zip(r, g, b)
+                ),
+                dtype=numpy.float64,
+                count=len(unique_keys),
+            )
+
+        weights[weights <= 0] = 1e-10
+
+        return (r, g, b), weights * counts
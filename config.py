@@ -5,10 +5,90 @@ class Config:
     MQTT_HOST = os.getenv("MQTT_HOST", "127.0.0.1")
     MQTT_USER = os.getenv("MQTT_USER", None)
     MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", None)
+    # Maximum number of unacknowledged homie messages
+    MQTT_MAX_IN_FLIGHT = int(os.getenv("MQTT_MAX_IN_FLIGHT", "20"))
 
     SPOTIFY_USERNAME = os.getenv("SPOTIFY_USERNAME", None)
+    # Comma separated list of usernames, each optionally followed by "=<homie device id>"
+    SPOTIFY_ACCOUNTS = os.getenv("SPOTIFY_ACCOUNTS", None)
     SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID", None)
     SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET", None)
     SPOTIFY_REDIRECT_URI = os.getenv(
         "SPOTIFY_REDIRECT_URI", "http://localhost:17382/redirect"
     )
+
+    # Budget of requests per second and burst shared by all accounts of the client id, by
+    # default the rate is derived from the number of accounts and POLL_INTERVAL
+    SPOTIFY_REQUEST_RATE = (
+        float(os.getenv("SPOTIFY_REQUEST_RATE"))
+        if os.getenv("SPOTIFY_REQUEST_RATE")
+        else None
+    )
+    SPOTIFY_REQUEST_BURST = float(os.getenv("SPOTIFY_REQUEST_BURST", "10"))
+    # Backoff after 429 and 5xx responses, doubled for every failure up to the maximum
+    SPOTIFY_BACKOFF_BASE = float(os.getenv("SPOTIFY_BACKOFF_BASE", "2"))
+    SPOTIFY_BACKOFF_MAX = float(os.getenv("SPOTIFY_BACKOFF_MAX", "300"))
+
+    # Bytes of cached responses for conditional requests, 0 to disable the HTTP cache
+    HTTP_CACHE_SIZE = int(os.getenv("HTTP_CACHE_SIZE", str(8 * 1024 * 1024)))
+    # Milliseconds a poll may deviate from the expected progress to count as unchanged
+    PLAYBACK_PROGRESS_TOLERANCE = int(os.getenv("PLAYBACK_PROGRESS_TOLERANCE", "2000"))
+
+    COLOR_SAMPLE_COUNT = int(os.getenv("COLOR_SAMPLE_COUNT", "1250"))
+    # One of "hue", "hue-brightness", "hsv" or "oklab"
+    COLOR_FILTER = os.getenv("COLOR_FILTER", "hue-brightness")
+    # Minimum edge length in pixels of the cover rendition that is downloaded and decoded
+    COVER_MIN_SIZE = int(os.getenv("COVER_MIN_SIZE", "300"))
+    # Publish a color estimated from a thumbnail right away and refine it once analysed
+    PROGRESSIVE = os.getenv("PROGRESSIVE", "false") == "true"
+    PROGRESSIVE_ESTIMATE_SIZE = int(os.getenv("PROGRESSIVE_ESTIMATE_SIZE", "64"))
+    PALETTE_SIZE = int(os.getenv("PALETTE_SIZE", "5"))
+    # Only every n-th pixel is considered for the palette, 1 is the highest quality
+    PALETTE_QUALITY = int(os.getenv("PALETTE_QUALITY", "1"))
+    # One of "mediancut", "maxcoverage", "fastoctree" or "libimagequant"
+    PALETTE_METHOD = os.getenv("PALETTE_METHOD", "mediancut")
+
+    # Number of processes analysing covers, 0 to analyse in the polling thread of the
+    # blocking runtime or a thread of the asyncio runtime, and maximum number of queued
+    # analyses
+    ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "1"))
+    ANALYSIS_MAX_PENDING = int(os.getenv("ANALYSIS_MAX_PENDING", "4"))
+
+    ANALYSIS_CACHE_PATH = os.getenv("ANALYSIS_CACHE_PATH", None)
+    ANALYSIS_CACHE_MEMORY_SIZE = int(os.getenv("ANALYSIS_CACHE_MEMORY_SIZE", "128"))
+    ANALYSIS_CACHE_DISK_SIZE = int(os.getenv("ANALYSIS_CACHE_DISK_SIZE", "4096"))
+
+    # File the published player states are kept in to restore them after a restart
+    STATE_SNAPSHOT_PATH = os.getenv("STATE_SNAPSHOT_PATH", None)
+
+    # Either "fixed" to poll every POLL_INTERVAL seconds or "adaptive"
+    POLL_MODE = os.getenv("POLL_MODE", "fixed")
+    POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "5"))
+    POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "1"))
+    POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "30"))
+    POLL_BOUNDARY_WINDOW = float(os.getenv("POLL_BOUNDARY_WINDOW", "3"))
+    POLL_IDLE_MAX_INTERVAL = float(os.getenv("POLL_IDLE_MAX_INTERVAL", "60"))
+
+    PREFETCH = os.getenv("PREFETCH", "true") == "true"
+    PREFETCH_LOOKAHEAD = float(os.getenv("PREFETCH_LOOKAHEAD", "20"))
+
+    # Stream interpolated colors as the non-retained transition/color property
+    TRANSITION_STREAM = os.getenv("TRANSITION_STREAM", "false") == "true"
+    TRANSITION_FRAME_RATE = float(os.getenv("TRANSITION_FRAME_RATE", "10"))
+    TRANSITION_DURATION = float(os.getenv("TRANSITION_DURATION", "1"))
+    # Cycle through the palette while a track is playing
+    TRANSITION_PALETTE_CYCLE = os.getenv("TRANSITION_PALETTE_CYCLE", "false") == "true"
+    TRANSITION_PALETTE_HOLD = float(os.getenv("TRANSITION_PALETTE_HOLD", "5"))
+
+    # Minimum seconds between two publishes of a player property, 0 to publish right away
+    PROPERTY_MIN_INTERVAL = float(os.getenv("PROPERTY_MIN_INTERVAL", "0"))
+
+    # Either "blocking" for the APScheduler based runtime or "asyncio"
+    RUNTIME = os.getenv("RUNTIME", "blocking")
+
+    # Serve Prometheus metrics on http://<METRICS_HOST>:<METRICS_PORT>/metrics if set
+    METRICS_PORT = int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None
+    METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+    # Publish statistics as $stats attributes of the homie devices
+    HOMIE_STATS = os.getenv("HOMIE_STATS", "false") == "true"
+    HOMIE_STATS_INTERVAL = float(os.getenv("HOMIE_STATS_INTERVAL", "60"))
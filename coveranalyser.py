@@ -0,0 +1,43 @@
+from typing import List, Tuple
+
+from PIL import Image
+
+from analysiscache import CoverAnalysis
+from colorfinder import NumpyColorFinder, get_color_filter
+from config import Config
+from imageingest import decode_cover
+from metrics import STAGE_SECONDS
+from palette import PaletteExtractor
+
+
+class CoverAnalyser:
+    def __init__(self):
+        self.color_finder = NumpyColorFinder(
+            get_color_filter(Config.COLOR_FILTER), Config.COLOR_SAMPLE_COUNT
+        )
+        self.palette_extractor = PaletteExtractor(
+            Config.PALETTE_SIZE, Config.PALETTE_QUALITY, Config.PALETTE_METHOD
+        )
+
+    def get_color_palette(self, image: Image) -> List[Tuple[int, int, int]]:
+        return self.palette_extractor.get_palette(image)
+
+    def estimate(self, data: bytes) -> Tuple[int, int, int]:
+        """
+        Estimate the dominant color from a thumbnail, fast enough to run before the analysis
+        """
+        with STAGE_SECONDS.time("estimate"):
+            image = decode_cover(data, Config.PROGRESSIVE_ESTIMATE_SIZE)
+            return self.color_finder.get_estimated_color(image)
+
+    def analyse(self, data: bytes) -> CoverAnalysis:
+        with STAGE_SECONDS.time("decode"):
+            image = decode_cover(data, Config.COVER_MIN_SIZE)
+
+        with STAGE_SECONDS.time("color"):
+            color = self.color_finder.get_most_prominent_color(image)
+
+        with STAGE_SECONDS.time("palette"):
+            palette = self.get_color_palette(image)
+
+        return CoverAnalysis(color=color, palette=palette)
@@ -0,0 +1,133 @@
+import random
+import time
+from threading import Lock
+from typing import Callable, Optional
+
+from metrics import SPOTIFY_REQUESTS_DEFERRED
+
+
+class RequestDeferredError(Exception):
+    """Raised instead of sending a request the governor holds back"""
+
+    def __init__(self, reason: str, delay: float):
+        super().__init__(f"Request deferred for {delay:.1f}s ({reason})")
+        self.reason = reason
+        self.delay = delay
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    :return: The seconds of a Retry-After header or None if it is missing or a date
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class RequestGovernor:
+    """
+    Keeps the requests of a Spotify client id within a token bucket budget and stops sending
+    requests while backing off. A 429 or 5xx response backs off exponentially with jitter,
+    so bridges sharing the client id do not resume at once, and at least for the time given
+    by Retry-After.
+    """
+
+    def __init__(
+        self,
+        rate: float = 1,
+        burst: float = 10,
+        backoff_base: float = 2,
+        backoff_max: float = 300,
+        clock: Callable[[], float] = time.monotonic,
+        get_random: Callable[[], float] = random.random,
+    ):
+        """
+        :param rate: Requests per second the budget is refilled with
+        :param burst: Maximum number of requests that can be sent at once
+        :param backoff_base: Seconds backed off after the first failure, doubled for every
+        following one
+        :param backoff_max: Maximum seconds backed off
+        """
+        self.rate = rate
+        self.burst = burst
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self.get_random = get_random
+        self.tokens = burst
+        self.updated = clock()
+        self.backoff_until = -float("inf")
+        self.failures = 0
+        self.lock = Lock()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_tokens(self) -> float:
+        with self.lock:
+            self.refill(self.clock())
+            return self.tokens
+
+    def get_backoff(self) -> float:
+        """
+        :return: Seconds until the backoff ends, 0 if not backing off
+        """
+        return max(0.0, self.backoff_until - self.clock())
+
+    def get_delay(self) -> float:
+        """
+        :return: Seconds until the next request may be sent
+        """
+        with self.lock:
+            now = self.clock()
+            self.refill(now)
+            return max(0.0, self.backoff_until - now, (1 - self.tokens) / self.rate)
+
+    def acquire(self, endpoint: str):
+        """
+        Take a request from the budget
+        :raise RequestDeferredError: If backing off or the budget is used up
+        """
+        with self.lock:
+            now = self.clock()
+
+            if now < self.backoff_until:
+                reason, delay = "backoff", self.backoff_until - now
+            else:
+                self.refill(now)
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                reason, delay = "budget", (1 - self.tokens) / self.rate
+
+        SPOTIFY_REQUESTS_DEFERRED.inc(endpoint, reason)
+        raise RequestDeferredError(reason, delay)
+
+    def on_response(self, status: int, retry_after: Optional[float] = None):
+        """
+        Back off after a 429 or 5xx response, any other response ends the backoff series
+        :param retry_after: Seconds of the Retry-After header of the response
+        """
+        with self.lock:
+            if status != 429 and status < 500:
+                self.failures = 0
+                return
+
+            backoff = min(
+                self.backoff_max, self.backoff_base * 2 ** min(self.failures, 32)
+            )
+            self.failures += 1
+            # At least half of the backoff, the rest is random
+            delay = backoff * (1 + self.get_random()) / 2
+
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+
+            self.backoff_until = max(self.backoff_until, self.clock() + delay)
@@ -1,8 +1,28 @@
+import sys
+import time
 import weakref
+from collections import deque
+from contextlib import contextmanager
 from enum import Enum
-from typing import Optional, Dict, Set, Any, Protocol, NamedTuple, List, Tuple, Union
+from threading import RLock, Timer, local
+from typing import (
+    Optional,
+    Dict,
+    Set,
+    Any,
+    Protocol,
+    NamedTuple,
+    List,
+    Tuple,
+    Union,
+    Deque,
+    Callable,
+    Iterable,
+    Iterator,
+)
 
 from packaging.version import Version, InvalidVersion
+from paho.mqtt.client import MQTT_ERR_SUCCESS
 
 from logger import get_logger
 
@@ -30,13 +50,78 @@ class HomieDataType(Enum):
 class HomieExtension(NamedTuple):
     extension_id: str
     extension_version: Version
-    supported_homie_versions: List[str]
+    supported_homie_versions: Tuple[str, ...]
 
     def __str__(self) -> str:
         return f"{self.extension_id}:{self.extension_version}:[{';'.join(self.supported_homie_versions)}]"
 
 
+def intern_payload(payload: Optional[str]) -> Optional[str]:
+    """
+    Share the string of a payload that repeats across many devices, like a unit or format
+    """
+    return None if payload is None else sys.intern(payload)
+
+
+class HomiePublishPolicy(NamedTuple):
+    # Skip values whose payload equals the last published one
+    change_only: bool = True
+    # Minimum seconds between two publishes of a property, the updates in between are
+    # coalesced into a single delayed publish of the latest value
+    min_interval: float = 0
+
+
+class DelayedCall(Protocol):
+    def cancel(self):
+        ...
+
+
+def start_timer(delay: float, callback: Callable[[], None]) -> DelayedCall:
+    """
+    Call a function after a delay from a timer thread, the default of
+    HomiePublisher.call_later for publishers that are not driven by a runtime
+    """
+    timer = Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+class HomiePublishState:
+    __slots__ = ("policy", "payload", "published", "published_at", "timer", "lock")
+
+    def __init__(self, policy: HomiePublishPolicy):
+        self.policy = policy
+        # Guards the state against the delayed publishes, the publisher lock must not be
+        # held around publishing as the acknowledged messages are processed after it
+        self.lock = RLock()
+        self.payload: Optional[str] = None
+        self.published = False
+        self.published_at = -float("inf")
+        self.timer: Optional[DelayedCall] = None
+
+
 class HomieProperty:
+    # Slotted and with lazily allocated containers, as installations have many properties
+    __slots__ = (
+        "parent_node",
+        "property_id",
+        "name",
+        "datatype",
+        "format",
+        "unit",
+        "retained",
+        "settable",
+        "_value",
+        "raw_value",
+        "_additional_attributes",
+        "topic",
+        "publish_state",
+        "__payload",
+        "__observers",
+        "__weakref__",
+    )
+
     def __init__(self, property_id: str, parent_node: "HomieNode", valid: bool = False):
         self.parent_node = weakref.proxy(parent_node)
         self.property_id = property_id
@@ -47,8 +132,15 @@ class HomieProperty:
         self.retained = True
         self.settable = False
         self._value: Optional[Union[int, float, bool, str, Tuple[int, int, int]]] = None
-        self.additional_attributes: Dict[str, Any] = {}
-        self.__observers: Set[HomiePropertyObserver] = set()
+        # Payload of a value that arrived before the datatype was known
+        self.raw_value: Optional[str] = None
+        self._additional_attributes: Optional[Dict[str, Any]] = None
+        self.topic: Optional[str] = None
+        # Publishes every value if no policy is set
+        self.publish_state: Optional[HomiePublishState] = None
+        # Formatted value and the datatype it has been formatted with
+        self.__payload: Optional[Tuple[Optional[HomieDataType], Optional[str]]] = None
+        self.__observers: Optional[Set[HomiePropertyObserver]] = None
         parent_node.properties[property_id] = self
 
         if valid:
@@ -63,19 +155,62 @@ class HomieProperty:
 
     @value.setter
     def value(self, value):
-        previous_value = self.value
+        previous_value = self._value
+
+        if value == previous_value:
+            return
+
         self._value = value
+        self.__payload = None
 
-        for observer in self.__observers:
-            observer.homie_property_updated(self, previous_value)
+        if self.__observers is not None:
+            for observer in self.__observers:
+                observer.homie_property_updated(self, previous_value)
+
+    @property
+    def additional_attributes(self) -> Dict[str, Any]:
+        if self._additional_attributes is None:
+            self._additional_attributes = {}
+
+        return self._additional_attributes
 
     def add_observer(self, observer: "HomiePropertyObserver"):
+        if self.__observers is None:
+            self.__observers = set()
+
         self.__observers.add(observer)
 
     def remove_observer(self, observer: "HomiePropertyObserver"):
+        if self.__observers is None:
+            raise KeyError(observer)
+
         self.__observers.remove(observer)
 
-    def formatted_value(self):
+    def set_publish_policy(self, policy: HomiePublishPolicy):
+        self.publish_state = HomiePublishState(policy)
+
+    def update_value(self, value) -> bool:
+        """
+        Set and publish a value
+        :return: False if the value did not change and nothing was published
+        """
+        if value == self._value:
+            return False
+
+        self.value = value
+        self.publish_value()
+        return True
+
+    def formatted_value(self) -> Optional[str]:
+        payload = self.__payload
+
+        if payload is None or payload[0] is not self.datatype:
+            payload = self.datatype, self.format_value()
+            self.__payload = payload
+
+        return payload[1]
+
+    def format_value(self) -> Optional[str]:
         if self._value is None:
             return None
 
@@ -95,46 +230,92 @@ class HomieProperty:
         if self.datatype == HomieDataType.BOOLEAN:
             return "true" if self._value else "false"
 
-    def publish_value(self):
-        parent_node = self.parent_node
-        parent_device = parent_node.parent_device
+    def get_topic(self) -> str:
+        if self.topic is None:
+            self.topic = f"{self.parent_node.get_topic()}/{self.property_id}"
+
+        return self.topic
+
+    def publish_value(self, force: bool = False):
+        """
+        Publish the value according to the publish policy, which is bypassed if forced.
+        Inside a batch of the device the value is published at the end of the batch.
+        """
+        if force or not self.parent_node.parent_device.defer_publish(self):
+            self.publish_with_policy(force)
+
+    def publish_with_policy(self, force: bool = False, due: bool = False):
+        """
+        :param due: Whether the minimum interval has passed according to the runtime, for
+        the delayed publishes
+        """
+        parent_device = self.parent_node.parent_device
+        state = self.publish_state
+
+        if state is None:
+            parent_device.publish(
+                self.get_topic(), self.formatted_value(), retain=self.retained
+            )
+            return
 
-        parent_device.mqtt_client.publish(
-            f"{HOMIE_PREFIX}/{parent_device.device_id}/{parent_node.node_id}/{self.property_id}",
-            self.formatted_value(),
-            retain=self.retained,
-            qos=1,
-        )
+        with state.lock:
+            payload = self.formatted_value()
+
+            if not force:
+                if (
+                    state.policy.change_only
+                    and state.published
+                    and state.payload == payload
+                ):
+                    return
+
+                delay = (
+                    state.published_at + state.policy.min_interval - time.monotonic()
+                )
+
+                if delay > 0 and not due:
+                    if state.timer is None:
+                        state.timer = parent_device.get_publisher().call_later(
+                            delay, self.publish_delayed
+                        )
+
+                    return
+
+            if state.timer is not None:
+                state.timer.cancel()
+                state.timer = None
+
+            state.payload = payload
+            state.published = True
+            state.published_at = time.monotonic()
+            parent_device.publish(self.get_topic(), payload, retain=self.retained)
+
+    def publish_delayed(self):
+        state = self.publish_state
+
+        with state.lock:
+            if state.timer is None:
+                # Cancelled while waiting for the lock
+                return
+
+            state.timer = None
+            self.publish_with_policy(due=True)
 
     def publish_config(self):
-        parent_node = self.parent_node
-        parent_device = parent_node.parent_device
+        topic = self.get_topic()
+        parent_device = self.parent_node.parent_device
 
+        parent_device.publish_qos1_retained(f"{topic}/$name", self.name)
+        parent_device.publish_qos1_retained(f"{topic}/$datatype", self.datatype.value)
+        parent_device.publish_qos1_retained(f"{topic}/$format", self.format)
+        parent_device.publish_qos1_retained(f"{topic}/$unit", self.unit)
         parent_device.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{parent_device.device_id}/{parent_node.node_id}/{self.property_id}/$name",
-            self.name,
-        )
-        parent_device.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{parent_device.device_id}/{parent_node.node_id}/{self.property_id}/$datatype",
-            self.datatype.value,
+            f"{topic}/$retained", "true" if self.retained else "false"
         )
         parent_device.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{parent_device.device_id}/{parent_node.node_id}/{self.property_id}/$format",
-            self.format,
+            f"{topic}/$settable", "true" if self.settable else "false"
         )
-        parent_device.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{parent_device.device_id}/{parent_node.node_id}/{self.property_id}/$unit",
-            self.unit,
-        )
-        parent_device.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{parent_device.device_id}/{parent_node.node_id}/{self.property_id}/$retained",
-            "true" if self.retained else "false",
-        )
-        parent_device.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{parent_device.device_id}/{parent_node.node_id}/{self.property_id}/$settable",
-            "true" if self.settable else "false",
-        )
-        self.publish_value()
+        self.publish_value(force=True)
 
         # TODO: Publish additional attributes?
 
@@ -155,7 +336,158 @@ class InvalidConfigurationError(Exception):
     pass
 
 
+class HomieMessage(NamedTuple):
+    topic: str
+    payload: Optional[str]
+    retain: bool
+    qos: int
+    barrier: bool
+
+
+class HomiePublisher:
+    """
+    Publishes messages in order while keeping the number of unacknowledged QoS 1 messages
+    below max_in_flight. Retained messages with an unchanged payload are skipped and barrier
+    messages are only sent after all previous messages have been acknowledged.
+    The on_publish method has to be registered as on_publish callback of the mqtt client,
+    see register.
+    """
+
+    def __init__(
+        self,
+        mqtt_client: MqttClient,
+        max_in_flight: int = 20,
+        call_later: Callable[[float, Callable[[], None]], DelayedCall] = start_timer,
+    ):
+        """
+        :param call_later: Schedules the delayed publishes of the publish policies, the
+        runtime that drives the client should run them where it publishes
+        """
+        # Devices create their publisher with their own proxy of the client
+        self.mqtt_client = (
+            mqtt_client
+            if isinstance(mqtt_client, weakref.ProxyType)
+            else weakref.proxy(mqtt_client)
+        )
+        self.max_in_flight = max_in_flight
+        self.call_later = call_later
+        self.queue: Deque[HomieMessage] = deque()
+        self.in_flight: Set[int] = set()
+        # Acknowledged message ids that have not been removed from in_flight yet
+        self.acknowledged: Deque[int] = deque()
+        self.retained_payloads: Dict[str, Optional[str]] = {}
+        self.lock = RLock()
+        self.flushing = False
+        self.sent_count = 0
+
+    def publish(
+        self,
+        topic: str,
+        payload: Optional[str],
+        retain: bool = False,
+        qos: int = 0,
+        barrier: bool = False,
+    ):
+        try:
+            with self.lock:
+                if retain and not barrier:
+                    if topic in self.retained_payloads:
+                        if self.retained_payloads[topic] == payload:
+                            return
+
+                    self.retained_payloads[topic] = payload
+
+                self.queue.append(HomieMessage(topic, payload, retain, qos, barrier))
+                self.flush()
+        finally:
+            self.process_acknowledged()
+
+    def register(self):
+        """
+        Register the publisher as on_publish callback of its client, without it the
+        messages in flight are never released
+        """
+        self.mqtt_client.on_publish = self.on_publish
+
+    def forget_retained(self, topic_prefix: str):
+        with self.lock:
+            for topic in [
+                t for t in self.retained_payloads if t.startswith(topic_prefix)
+            ]:
+                del self.retained_payloads[topic]
+
+        self.process_acknowledged()
+
+    def on_publish(self, client, userdata, mid: int):
+        # The network thread of the client holds its own locks while calling this, so it
+        # must not wait for a thread that holds the lock and is publishing
+        self.acknowledged.append(mid)
+        self.process_acknowledged()
+
+    def process_acknowledged(self):
+        """
+        Release the acknowledged messages and send the next ones. Has to be called after
+        the lock has been released, as acknowledgements are left to the holder of the lock.
+        """
+        while self.acknowledged:
+            if not self.lock.acquire(blocking=False):
+                return
+
+            try:
+                while self.acknowledged:
+                    self.in_flight.discard(self.acknowledged.popleft())
+
+                self.flush()
+            finally:
+                self.lock.release()
+
+    def flush(self):
+        with self.lock:
+            if self.flushing:
+                # Called from a callback while sending, the running flush continues
+                return
+
+            self.flushing = True
+
+            try:
+                while self.queue and len(self.in_flight) < self.max_in_flight:
+                    if self.queue[0].barrier and self.in_flight:
+                        break
+
+                    message = self.queue.popleft()
+                    self.sent_count += 1
+                    message_info = self.mqtt_client.publish(
+                        message.topic,
+                        message.payload,
+                        retain=message.retain,
+                        qos=message.qos,
+                    )
+
+                    if (
+                        message.qos > 0
+                        and message_info is not None
+                        # Failed, e.g. while disconnected, is_published() would raise
+                        and message_info.rc == MQTT_ERR_SUCCESS
+                        and not message_info.is_published()
+                    ):
+                        self.in_flight.add(message_info.mid)
+            finally:
+                self.flushing = False
+
+
 class HomieNode:
+    __slots__ = (
+        "parent_device",
+        "node_id",
+        "name",
+        "type",
+        "valid_properties",
+        "properties",
+        "_additional_attributes",
+        "topic",
+        "__weakref__",
+    )
+
     def __init__(self, node_id: str, parent_device: "HomieDevice", valid: bool = False):
         self.parent_device = weakref.proxy(parent_device)
         self.node_id = node_id
@@ -163,7 +495,8 @@ class HomieNode:
         self.type: Optional[str] = None
         self.valid_properties: Optional[Set[str]] = None
         self.properties: Dict[str, HomieProperty] = {}
-        self.additional_attributes: Dict[str, Any] = {}
+        self._additional_attributes: Optional[Dict[str, Any]] = None
+        self.topic: Optional[str] = None
         parent_device.nodes[node_id] = self
 
         if valid:
@@ -172,17 +505,26 @@ class HomieNode:
 
             parent_device.valid_nodes.add(node_id)
 
+    @property
+    def additional_attributes(self) -> Dict[str, Any]:
+        if self._additional_attributes is None:
+            self._additional_attributes = {}
+
+        return self._additional_attributes
+
+    def get_topic(self) -> str:
+        if self.topic is None:
+            self.topic = f"{self.parent_device.topic}/{self.node_id}"
+
+        return self.topic
+
     def publish_config(self):
+        topic = self.get_topic()
         parent = self.parent_device
+        parent.publish_qos1_retained(f"{topic}/$name", self.name)
+        parent.publish_qos1_retained(f"{topic}/$type", self.type)
         parent.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{parent.device_id}/{self.node_id}/$name", self.name
-        )
-        parent.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{parent.device_id}/{self.node_id}/$type", self.type
-        )
-        parent.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{parent.device_id}/{self.node_id}/$properties",
-            ",".join(self.valid_properties),
+            f"{topic}/$properties", ",".join(self.valid_properties)
         )
 
         # TODO: Publish additional attributes?
@@ -194,24 +536,82 @@ class HomieNode:
         return f"{{HomieNode: {self.node_id}}}"
 
 
+# The batches are per thread, so updates from other threads are not deferred with them
+batch_state = local()
+
+
+def get_batches() -> Dict["HomieDevice", Dict[str, HomieProperty]]:
+    """
+    :return: Properties to publish at the end of the running batches of this thread, by device
+    """
+    batches = getattr(batch_state, "batches", None)
+
+    if batches is None:
+        batches = batch_state.batches = {}
+
+    return batches
+
+
 class HomieDevice:
-    def __init__(self, device_id: str, mqtt_client: MqttClient):
+    __slots__ = (
+        "mqtt_client",
+        "publisher",
+        "name",
+        "device_id",
+        "topic",
+        "version",
+        "state",
+        "extensions",
+        "implementation",
+        "valid_nodes",
+        "nodes",
+        "_additional_attributes",
+        "is_valid",
+        "__weakref__",
+    )
+
+    def __init__(
+        self,
+        device_id: str,
+        mqtt_client: MqttClient,
+        publisher: Optional[HomiePublisher] = None,
+    ):
         self.mqtt_client = weakref.proxy(mqtt_client)
+        self.publisher = publisher
         self.name: Optional[str] = None
         self.device_id = device_id
+        self.topic = f"{HOMIE_PREFIX}/{device_id}"
         self.version: Optional[Version] = None
         self.state: Optional[HomieState] = None
         self.extensions: Optional[Set[HomieExtension]] = None
         self.implementation: Optional[str] = None
         self.valid_nodes: Optional[Set[str]] = None
         self.nodes: Dict[str, HomieNode] = {}
-        self.additional_attributes: Dict[str, Any] = {}
+        self._additional_attributes: Optional[Dict[str, Any]] = None
         self.is_valid = False
 
+    @property
+    def additional_attributes(self) -> Dict[str, Any]:
+        if self._additional_attributes is None:
+            self._additional_attributes = {}
+
+        return self._additional_attributes
+
     def validate(self) -> bool:
         self.is_valid = self.__validate()
+
+        if self.is_valid:
+            self.cache_topics()
+
         return self.is_valid
 
+    def cache_topics(self):
+        for node in self.nodes.values():
+            node.get_topic()
+
+            for node_property in node.properties.values():
+                node_property.get_topic()
+
     def __validate(self) -> bool:
         if (
             self.name is None
@@ -221,10 +621,11 @@ class HomieDevice:
         ):
             return False
 
-        # Filter gathered nodes
-        self.nodes = {k: v for k, v in self.nodes.items() if k in self.valid_nodes}
+        # Drop gathered nodes that are not announced
+        for node_id in self.nodes.keys() - self.valid_nodes:
+            del self.nodes[node_id]
 
-        if self.valid_nodes != self.nodes.keys():
+        if len(self.valid_nodes) != len(self.nodes):
             # Required nodes are missing
             return False
 
@@ -232,11 +633,10 @@ class HomieDevice:
             if node.name is None or node.type is None or node.valid_properties is None:
                 return False
 
-            node.properties = {
-                k: v for k, v in node.properties.items() if k in node.valid_properties
-            }
+            for property_id in node.properties.keys() - node.valid_properties:
+                del node.properties[property_id]
 
-            if node.valid_properties != node.properties.keys():
+            if len(node.valid_properties) != len(node.properties):
                 # Required properties are missing
                 return False
 
@@ -246,40 +646,95 @@ class HomieDevice:
 
         return True
 
-    def publish_qos1_retained(self, topic: str, payload: Optional[str]):
-        self.mqtt_client.publish(topic, payload, retain=True, qos=1)
+    def get_publisher(self) -> HomiePublisher:
+        if self.publisher is None:
+            # Only devices without a shared publisher, which owns the callback of the client
+            self.publisher = HomiePublisher(self.mqtt_client)
+            self.publisher.register()
 
-    def publish_config(self):
+        return self.publisher
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Publish the values of the properties updated within the block at its end, so a
+        property that is updated several times is published once with its latest value
+        """
+        batches = get_batches()
+
+        if self in batches:
+            yield
+            return
+
+        deferred_properties = batches[self] = {}
+
+        try:
+            yield
+        finally:
+            del batches[self]
+
+            for homie_property in deferred_properties.values():
+                homie_property.publish_value()
+
+    def defer_publish(self, homie_property: HomieProperty) -> bool:
+        """
+        :return: True if the property is published at the end of the running batch
+        """
+        deferred_properties = get_batches().get(self)
+
+        if deferred_properties is None:
+            return False
+
+        deferred_properties[homie_property.get_topic()] = homie_property
+        return True
+
+    def publish(self, topic: str, payload: Optional[str], retain: bool, qos: int = 1):
+        self.get_publisher().publish(topic, payload, retain=retain, qos=qos)
+
+    def publish_qos1_retained(self, topic: str, payload: Optional[str]):
+        self.get_publisher().publish(topic, payload, retain=True, qos=1)
+
+    def publish_additional_attribute(self, levels: List[str], payload: Optional[str]):
+        """
+        Publish an attribute of an extension, e.g. ["$stats", "uptime"] for $stats/uptime
+        """
+        add_additional_attribute(self.additional_attributes, levels, payload)
+        self.publish_qos1_retained(f"{self.topic}/{'/'.join(levels)}", payload)
+
+    def publish_config(self, force: bool = False):
+        """
+        Publish the configuration and values of the device. Retained attributes that have
+        already been published with the same payload are skipped unless force is set.
+        """
         if not self.validate():
             raise InvalidConfigurationError()
 
-        self.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{self.device_id}/$state", HomieState.INIT.value
-        )
+        publisher = self.get_publisher()
 
-        self.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{self.device_id}/$homie", str(self.version)
-        )
-        self.publish_qos1_retained(f"{HOMIE_PREFIX}/{self.device_id}/$name", self.name)
-        self.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{self.device_id}/$extensions",
-            ",".join(str(extension) for extension in self.extensions),
-        )
-        self.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{self.device_id}/$implementation", self.implementation
+        if force:
+            publisher.forget_retained(f"{self.topic}/")
+
+        publisher.publish(
+            f"{self.topic}/$state", HomieState.INIT.value, True, 1, barrier=True
         )
 
+        self.publish_qos1_retained(f"{self.topic}/$homie", str(self.version))
+        self.publish_qos1_retained(f"{self.topic}/$name", self.name)
         self.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{self.device_id}/$nodes", ",".join(self.valid_nodes)
+            f"{self.topic}/$extensions",
+            ",".join(str(extension) for extension in self.extensions),
         )
+        self.publish_qos1_retained(f"{self.topic}/$implementation", self.implementation)
+        self.publish_qos1_retained(f"{self.topic}/$nodes", ",".join(self.valid_nodes))
 
         # TODO: Publish additional attributes?
 
         for node_id in self.valid_nodes:
             self.nodes[node_id].publish_config()
 
-        self.publish_qos1_retained(
-            f"{HOMIE_PREFIX}/{self.device_id}/$state", HomieState.READY.value
+        # Only sent after everything else has been acknowledged
+        publisher.publish(
+            f"{self.topic}/$state", HomieState.READY.value, True, 1, barrier=True
         )
         self.state = HomieState.READY
 
@@ -307,6 +762,7 @@ def add_additional_attribute(
     if len(remaining_levels) > 1:
         if remaining_levels[0] not in attribute_dict:
             current_level = {}
+            attribute_dict[remaining_levels[0]] = current_level
         else:
             current_level = attribute_dict[remaining_levels[0]]
 
@@ -315,19 +771,92 @@ def add_additional_attribute(
         attribute_dict[remaining_levels[0]] = payload
 
 
+HomieMessageHandler = Callable[[Any, Optional[str]], None]
+
+
+# Handler and the object it is applied to
+HomieRoute = Tuple[HomieMessageHandler, Any]
+
+
+# Topic, device, handler and the object the handler is applied to
+HomieConfigRoute = Tuple[str, HomieDevice, HomieMessageHandler, Any]
+
+
+def ignore_homie_message(target: Any, payload: Optional[str]):
+    pass
+
+
+def set_additional_attribute(
+    target: Tuple[Dict[str, Any], List[str]], payload: Optional[str]
+):
+    add_additional_attribute(target[0], target[1], payload)
+
+
 class HomieManager:
+    """
+    Builds the homie devices seen on the broker from their messages. A device is validated
+    once its configuration has been quiet for validation_delay seconds after it announced
+    itself as ready, and the delegate is notified once for every configuration that
+    validates. Notifications are sent from a timer thread unless validation_delay is 0.
+    """
+
     def __init__(
-        self, mqtt_client: MqttClient, delegate: Optional[HomieManagerDelegate] = None
+        self,
+        mqtt_client: MqttClient,
+        delegate: Optional[HomieManagerDelegate] = None,
+        max_routes: int = 65536,
+        validation_delay: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+        publisher: Optional[HomiePublisher] = None,
     ):
+        """
+        :param publisher: The publisher registered for the client if there is one, else
+        the devices share one that is registered on first use
+        """
         self.homie_devices: Dict[str, HomieDevice] = {}
         self.logger = get_logger("HomieManager")
         self.mqtt_client = mqtt_client
+        self.publisher = publisher
+        self.deferred_validations: Optional[Set[str]] = None
+        self.routes: Dict[str, HomieRoute] = {}
+        self.max_routes = max_routes
+        self.validation_delay = validation_delay
+        self.clock = clock
+        self.lock = RLock()
+        self.validation_timer: Optional[Timer] = None
+        self.validation_deadlines: Dict[str, float] = {}
+        # Last payload and the object it has been applied to per configuration topic
+        self.config_payloads: Dict[str, Tuple[Any, Optional[str]]] = {}
+        self.config_versions: Dict[str, int] = {}
+        self.validated_versions: Dict[str, int] = {}
 
         if delegate is not None:
             self.delegate = weakref.proxy(delegate)
         else:
             self.delegate = None
 
+        # Handlers for the last topic level, separated by the depth of the topic
+        self.device_handlers: Dict[str, HomieMessageHandler] = {
+            "$homie": self.on_device_homie,
+            "$name": self.on_device_name,
+            "$extensions": self.on_device_extensions,
+            "$nodes": self.on_device_nodes,
+            "$implementation": self.on_device_implementation,
+        }
+        self.node_handlers: Dict[str, HomieMessageHandler] = {
+            "$name": self.on_node_name,
+            "$type": self.on_node_type,
+            "$properties": self.on_node_properties,
+        }
+        self.property_handlers: Dict[str, HomieMessageHandler] = {
+            "$name": self.on_property_name,
+            "$datatype": self.on_property_datatype,
+            "$settable": self.on_property_settable,
+            "$retained": self.on_property_retained,
+            "$unit": self.on_property_unit,
+            "$format": self.on_property_format,
+        }
+
     def parse_with_datatype(self, datatype: HomieDataType, payload: str):
         try:
             if datatype == HomieDataType.INTEGER:
@@ -352,206 +881,432 @@ class HomieManager:
 
         return None
 
+    def get_device(self, device_id: str) -> HomieDevice:
+        device = self.homie_devices.get(device_id)
+
+        if device is None:
+            device_id = sys.intern(device_id)
+            device = HomieDevice(device_id, self.mqtt_client, self.get_publisher())
+            self.homie_devices[device_id] = device
+
+        return device
+
+    def get_publisher(self) -> HomiePublisher:
+        if self.publisher is None:
+            self.publisher = HomiePublisher(self.mqtt_client)
+            self.publisher.register()
+
+        return self.publisher
+
+    @staticmethod
+    def get_node(device: HomieDevice, node_id: str) -> HomieNode:
+        node = device.nodes.get(node_id)
+
+        if node is None:
+            node = HomieNode(sys.intern(node_id), device)
+
+        return node
+
+    @staticmethod
+    def get_property(node: HomieNode, property_id: str) -> HomieProperty:
+        homie_property = node.properties.get(property_id)
+
+        if homie_property is None:
+            homie_property = HomieProperty(sys.intern(property_id), node)
+
+        return homie_property
+
+    def on_homie_messages(
+        self, messages: Iterable[Tuple[str, Optional[str], bool]]
+    ) -> None:
+        """
+        Apply a burst of messages, e.g. the retained messages after subscribing, in one pass.
+        Devices that are ready are validated right after all messages have been applied,
+        without waiting for the validation delay.
+        :param messages: Tuples of topic, payload and retained flag
+        """
+        with self.lock:
+            self.deferred_validations = set()
+
+            try:
+                for topic, payload, retained in messages:
+                    self.on_homie_message(topic, payload, retained)
+            finally:
+                device_ids = self.deferred_validations
+                self.deferred_validations = None
+
+            for device_id in device_ids:
+                self.validation_deadlines.pop(device_id, None)
+
+            validated_devices = [
+                device
+                for device in map(self.homie_devices.get, device_ids)
+                if self.validate_device(device)
+            ]
+
+        self.notify_validated(validated_devices)
+
     def on_homie_message(self, topic: str, payload: Optional[str], retained: bool):
+        with self.lock:
+            route = self.routes.get(topic)
+
+            if route is None:
+                route = self.compile_route(topic)
+
+            handler, target = route
+            handler(target, payload)
+
+    def add_route(
+        self, topic: str, handler: HomieMessageHandler, target: Any
+    ) -> HomieRoute:
+        if len(self.routes) >= self.max_routes:
+            self.routes.clear()
+
+        route = (handler, target)
+        self.routes[topic] = route
+        return route
+
+    def get_config_route(
+        self, topic: str, device: HomieDevice, handler: HomieMessageHandler, target: Any
+    ) -> HomieRoute:
+        return (self.on_config_message, (topic, device, handler, target))
+
+    def compile_route(self, topic: str) -> HomieRoute:
+        """
+        Parse a topic and resolve the handler and the device, node or property it applies
+        to. Routes of property values and extension attributes are cached until the next
+        validation, as these are the messages that repeat.
+        """
         topic_levels = topic.split("/")
         number_of_levels = len(topic_levels)
 
         if number_of_levels > 1 and topic_levels[1] == "$broadcast":
             # Ignore broadcasts
-            return
+            return (ignore_homie_message, None)
 
         if number_of_levels < 3:
-            self.logger.warn(
-                f"Could not parse incoming homie message for topic {topic}"
-            )
-            return
+            return (self.on_unparsable_message, topic)
 
         if topic_levels[1] == "homelocator":
-            if number_of_levels != 5 or topic_levels[4] != "set":
-                # Ignore all messages that are not set
-                return
-
             # TODO: Received set for homelocator property of own device (But currently nothing is settable)
-            return
+            return (ignore_homie_message, None)
 
-        device_id = topic_levels[1]
-
-        if device_id not in self.homie_devices:
-            device = HomieDevice(device_id, self.mqtt_client)
-            self.homie_devices[device_id] = device
-        else:
-            device = self.homie_devices[device_id]
+        device = self.get_device(topic_levels[1])
 
         if number_of_levels == 3:
             level_str = topic_levels[2]
 
-            if level_str == "$homie":
-                try:
-                    device.version = Version(payload)
-                except InvalidVersion:
-                    self.logger.error("Failed to parse homie version")
-            elif level_str == "$name":
-                device.name = payload
-            elif level_str == "$extensions":
-                if payload is not None:
-                    device.extensions = set()
-                    extensions = payload.split(",")
-
-                    for extension in extensions:
-                        splitted = extension.split(":")
-
-                        if len(splitted) != 3:
-                            self.logger.warn("Failed to parse homie extension!")
-                            return
+            if level_str == "$state":
+                return self.add_route(topic, self.on_device_state, device)
 
-                        try:
-                            extension_version = Version(splitted[1])
-                        except InvalidVersion:
-                            self.logger.error("Failed to parse extension version")
-                            return
+            handler = self.device_handlers.get(level_str)
 
-                        homie_versions = splitted[3]
+            if handler is not None:
+                return self.get_config_route(topic, device, handler, device)
+            elif level_str.startswith("$"):
+                # Must be an extension attribute
+                return self.add_route(
+                    topic,
+                    set_additional_attribute,
+                    (device.additional_attributes, [level_str]),
+                )
+            else:
+                return (self.on_unknown_message, topic)
 
-                        if homie_versions[0] != "[" or homie_versions[-1] != "]":
-                            self.logger.error("Invalid supported homie versions")
-                            return
+        node_id = topic_levels[2]
 
-                        homie_versions = homie_versions[1:-1].split(";")
+        if node_id.startswith("$"):
+            # This must be an device attribute of an extension
+            return self.add_route(
+                topic,
+                set_additional_attribute,
+                (device.additional_attributes, topic_levels[2:]),
+            )
 
-                        device.extensions.add(
-                            HomieExtension(
-                                extension_id=splitted[0],
-                                extension_version=extension_version,
-                                supported_homie_versions=homie_versions,
-                            )
-                        )
-            elif level_str == "$nodes":
-                if payload is not None:
-                    device.valid_nodes = set(payload.split(","))
-            elif level_str == "$implementation":
-                device.implementation = payload
-            elif level_str == "$state":
-                # TODO: Validate changes after delay, so remaining messages for configuration can come in in time
-                try:
-                    device.state = HomieState(payload)
-
-                    if device.state == HomieState.READY:
-                        if device.validate():
-                            # Device has been validated
-                            if self.delegate is not None:
-                                try:
-                                    self.delegate().on_validated_homie_device(device)
-                                except ReferenceError:
-                                    self.delegate = None
-
-                except ValueError:
-                    self.logger.error(
-                        f"Failed to parse homie state for device {device_id}"
-                    )
+        node = self.get_node(device, node_id)
+
+        if number_of_levels == 4:
+            level_str = topic_levels[3]
+            handler = self.node_handlers.get(level_str)
+
+            if handler is not None:
+                return self.get_config_route(topic, device, handler, node)
+            elif level_str.startswith("$"):
+                # Must be a homie extension atttribute
+                return self.add_route(
+                    topic,
+                    set_additional_attribute,
+                    (node.additional_attributes, [level_str]),
+                )
             else:
-                if level_str.startswith("$"):
-                    # Must be an extension attribute
-                    device.additional_attributes[level_str] = payload
-                else:
-                    self.logger.warn("Received unknown homie message")
-        elif number_of_levels > 3:
-            node_id = topic_levels[2]
-
-            if node_id.startswith("$"):
-                # This must be an device attribute of an extension
-                add_additional_attribute(
-                    device.additional_attributes, topic_levels[2:], payload
+                return self.add_route(
+                    topic,
+                    self.on_property_value,
+                    self.get_property(node, level_str),
                 )
+
+        property_id = topic_levels[3]
+
+        if property_id.startswith("$"):
+            return self.add_route(
+                topic,
+                set_additional_attribute,
+                (node.additional_attributes, topic_levels[2:]),
+            )
+
+        homie_property = self.get_property(node, property_id)
+        level_str = topic_levels[4]
+
+        if level_str == "set":
+            # Ignore sets for other devices
+            return (ignore_homie_message, None)
+
+        handler = self.property_handlers.get(level_str)
+
+        if handler is not None:
+            return self.get_config_route(topic, device, handler, homie_property)
+        elif level_str.startswith("$"):
+            return self.add_route(
+                topic,
+                set_additional_attribute,
+                (homie_property.additional_attributes, topic_levels[4:]),
+            )
+        else:
+            return (self.on_unknown_message, topic)
+
+    def on_unparsable_message(self, topic: str, payload: Optional[str]):
+        self.logger.warn(f"Could not parse incoming homie message for topic {topic}")
+
+    def on_unknown_message(self, topic: str, payload: Optional[str]):
+        self.logger.warn("Received unknown homie message")
+
+    def on_config_message(self, config: HomieConfigRoute, payload: Optional[str]):
+        topic, device, handler, target = config
+        previous = self.config_payloads.get(topic)
+
+        if previous is not None and previous[0] is target and previous[1] == payload:
+            # Repeated retained configuration, e.g. after resubscribing
+            return
+
+        self.config_payloads[topic] = (target, payload)
+        handler(target, payload)
+
+        device_id = device.device_id
+        self.config_versions[device_id] = self.config_versions.get(device_id, 0) + 1
+
+        if device.state == HomieState.READY:
+            # Configuration that arrives after the device is ready must be validated too
+            self.schedule_validation(device)
+
+    def schedule_validation(self, device: HomieDevice):
+        if self.deferred_validations is not None:
+            self.deferred_validations.add(device.device_id)
+        elif self.validation_delay <= 0:
+            if self.validate_device(device):
+                self.notify_validated([device])
+        else:
+            deadline = self.clock() + self.validation_delay
+            self.validation_deadlines[device.device_id] = deadline
+
+            if self.validation_timer is None:
+                self.start_validation_timer(self.validation_delay)
+
+    def start_validation_timer(self, delay: float):
+        self.validation_timer = Timer(delay, self.validate_due_devices)
+        self.validation_timer.daemon = True
+        self.validation_timer.start()
+
+    def stop(self):
+        """
+        Cancel pending validations
+        """
+        with self.lock:
+            if self.validation_timer is not None:
+                self.validation_timer.cancel()
+                self.validation_timer = None
+
+            self.validation_deadlines.clear()
+
+    def validate_due_devices(self):
+        """
+        Validate all devices whose configuration has been quiet for the validation delay
+        and wait for the remaining ones
+        """
+        with self.lock:
+            self.validation_timer = None
+            now = self.clock()
+            due_device_ids = [
+                device_id
+                for device_id, deadline in self.validation_deadlines.items()
+                if deadline <= now
+            ]
+
+            for device_id in due_device_ids:
+                del self.validation_deadlines[device_id]
+
+            validated_devices = [
+                device
+                for device in map(self.homie_devices.get, due_device_ids)
+                if self.validate_device(device)
+            ]
+
+            if self.validation_deadlines:
+                next_deadline = min(self.validation_deadlines.values())
+                self.start_validation_timer(max(0.0, next_deadline - now))
+
+        self.notify_validated(validated_devices)
+
+    def validate_device(self, device: HomieDevice) -> bool:
+        """
+        Validate a device unless its current configuration has already been validated
+        :return: Whether the delegate has to be notified about the device
+        """
+        if device.state != HomieState.READY:
+            return False
+
+        device_id = device.device_id
+        config_version = self.config_versions.get(device_id, 0)
+
+        if self.validated_versions.get(device_id) == config_version:
+            return False
+
+        self.validated_versions[device_id] = config_version
+
+        # Validation drops nodes and properties that are not announced, so routes
+        # resolved to them must not be used anymore
+        self.routes.clear()
+
+        return device.validate()
+
+    def notify_validated(self, devices: List[HomieDevice]):
+        for device in devices:
+            if self.delegate is None:
                 return
 
-            if node_id not in device.nodes:
-                node = HomieNode(node_id, device)
-                device.nodes[node_id] = node
-            else:
-                node = device.nodes[node_id]
-
-            if number_of_levels == 4:
-                level_str = topic_levels[3]
-
-                if level_str == "$name":
-                    node.name = payload
-                elif level_str == "$type":
-                    node.type = payload
-                elif level_str == "$properties":
-                    if payload is not None:
-                        node.valid_properties = set(payload.split(","))
-                else:
-                    if level_str.startswith("$"):
-                        # Must be a homie extension atttribute
-                        node.additional_attributes[level_str] = payload
-                        return
-                    else:
-                        property_id = level_str
-
-                        if property_id not in node.properties:
-                            homie_property = HomieProperty(property_id, node)
-                            node.properties[property_id] = homie_property
-                        else:
-                            homie_property = node.properties[property_id]
-
-                        if payload is None:
-                            homie_property.value = None
-                        else:
-                            if homie_property.datatype is not None:
-                                homie_property.value = self.parse_with_datatype(
-                                    homie_property.datatype, payload
-                                )
-                            else:
-                                homie_property.raw_value = payload
-            elif number_of_levels >= 5:
-                property_id = topic_levels[3]
-
-                if property_id.startswith("$"):
-                    add_additional_attribute(
-                        node.additional_attributes, topic_levels[2:], payload
-                    )
-                    return
+            try:
+                self.delegate.on_validated_homie_device(device)
+            except ReferenceError:
+                self.delegate = None
 
-                if property_id not in node.properties:
-                    homie_property = HomieProperty(property_id, node)
-                    node.properties[property_id] = homie_property
-                else:
-                    homie_property = node.properties[property_id]
-
-                level_str = topic_levels[4]
-
-                if level_str == "$name":
-                    homie_property.name = payload
-                elif level_str == "$datatype":
-                    try:
-                        homie_property.datatype = HomieDataType(payload)
-
-                        if homie_property.raw_value is not None:
-                            homie_property.value = self.parse_with_datatype(
-                                homie_property.datatype, homie_property.raw_value
-                            )
-                            homie_property.raw_value = None
-                    except ValueError as ex:
-                        self.logger.error(
-                            f"Failed to parse homie property data type: {ex}"
-                        )
-                elif level_str == "$settable":
-                    homie_property.settable = payload == "true"
-                elif level_str == "$retained":
-                    homie_property.retained = payload == "true"
-                elif level_str == "$unit":
-                    homie_property.unit = payload
-                elif level_str == "$format":
-                    homie_property.format = payload
-                elif level_str == "set":
-                    # Ignore sets for other devices
-                    pass
-                else:
-                    if level_str.startswith("$"):
-                        add_additional_attribute(
-                            homie_property.additional_attributes,
-                            topic_levels[4:],
-                            payload,
-                        )
-                    else:
-                        self.logger.warn("Received unknown homie message")
+    def on_device_homie(self, device: HomieDevice, payload: Optional[str]):
+        try:
+            device.version = Version(payload)
+        except InvalidVersion:
+            self.logger.error("Failed to parse homie version")
+
+    @staticmethod
+    def on_device_name(device: HomieDevice, payload: Optional[str]):
+        device.name = payload
+
+    def on_device_extensions(self, device: HomieDevice, payload: Optional[str]):
+        if payload is None:
+            return
+
+        device.extensions = set()
+
+        for extension in payload.split(","):
+            splitted = extension.split(":")
+
+            if len(splitted) != 3:
+                self.logger.warn("Failed to parse homie extension!")
+                return
+
+            try:
+                extension_version = Version(splitted[1])
+            except InvalidVersion:
+                self.logger.error("Failed to parse extension version")
+                return
+
+            homie_versions = splitted[2]
+
+            if homie_versions[0] != "[" or homie_versions[-1] != "]":
+                self.logger.error("Invalid supported homie versions")
+                return
+
+            device.extensions.add(
+                HomieExtension(
+                    extension_id=splitted[0],
+                    extension_version=extension_version,
+                    supported_homie_versions=tuple(homie_versions[1:-1].split(";")),
+                )
+            )
+
+    @staticmethod
+    def on_device_nodes(device: HomieDevice, payload: Optional[str]):
+        if payload is not None:
+            device.valid_nodes = set(payload.split(","))
+
+    @staticmethod
+    def on_device_implementation(device: HomieDevice, payload: Optional[str]):
+        device.implementation = payload
+
+    def on_device_state(self, device: HomieDevice, payload: Optional[str]):
+        try:
+            device.state = HomieState(payload)
+        except ValueError:
+            self.logger.error(
+                f"Failed to parse homie state for device {device.device_id}"
+            )
+            return
+
+        if device.state == HomieState.READY:
+            # Validated after a quiet period, so the remaining configuration can come in
+            self.schedule_validation(device)
+
+    @staticmethod
+    def on_node_name(node: HomieNode, payload: Optional[str]):
+        node.name = payload
+
+    @staticmethod
+    def on_node_type(node: HomieNode, payload: Optional[str]):
+        node.type = intern_payload(payload)
+
+    @staticmethod
+    def on_node_properties(node: HomieNode, payload: Optional[str]):
+        if payload is not None:
+            node.valid_properties = set(payload.split(","))
+
+    def on_property_value(self, homie_property: HomieProperty, payload: Optional[str]):
+        if payload is None:
+            homie_property.value = None
+        elif homie_property.datatype is not None:
+            homie_property.value = self.parse_with_datatype(
+                homie_property.datatype, payload
+            )
+        else:
+            homie_property.raw_value = payload
+
+    @staticmethod
+    def on_property_name(homie_property: HomieProperty, payload: Optional[str]):
+        homie_property.name = payload
+
+    def on_property_datatype(
+        self, homie_property: HomieProperty, payload: Optional[str]
+    ):
+        try:
+            homie_property.datatype = HomieDataType(payload)
+        except ValueError as ex:
+            self.logger.error(f"Failed to parse homie property data type: {ex}")
+            return
+
+        if homie_property.raw_value is not None:
+            homie_property.value = self.parse_with_datatype(
+                homie_property.datatype, homie_property.raw_value
+            )
+            homie_property.raw_value = None
+
+    @staticmethod
+    def on_property_settable(homie_property: HomieProperty, payload: Optional[str]):
+        homie_property.settable = payload == "true"
+
+    @staticmethod
+    def on_property_retained(homie_property: HomieProperty, payload: Optional[str]):
+        homie_property.retained = payload == "true"
+
+    @staticmethod
+    def on_property_unit(homie_property: HomieProperty, payload: Optional[str]):
+        homie_property.unit = intern_payload(payload)
+
+    @staticmethod
+    def on_property_format(homie_property: HomieProperty, payload: Optional[str]):
+        homie_property.format = intern_payload(payload)
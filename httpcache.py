@@ -0,0 +1,179 @@
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import NamedTuple, Optional, Dict, Mapping, Callable
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from metrics import HTTP_CACHE_LOOKUPS
+
+MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    headers: Dict[str, str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    # clock() until which the body may be used without asking the server
+    fresh_until: float
+
+
+def get_cache_key(url: str, authorization: Optional[str]) -> str:
+    # API responses depend on the user of the token
+    return url if authorization is None else f"{url}|{authorization}"
+
+
+class HttpCache:
+    """
+    Bodies of GET responses with their validators, so requests can be made conditional with
+    If-None-Match and If-Modified-Since and a 304 Not Modified is answered from the cache.
+    Responses are used without a request while fresh according to Cache-Control max-age.
+    Entries are evicted in LRU order once the bodies exceed max_size bytes.
+    """
+
+    def __init__(self, max_size: int, clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.clock = clock
+        self.entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+            return entry
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        """
+        :return: True if the cached response may be used without a request
+        """
+        if entry.fresh_until <= self.clock():
+            return False
+
+        HTTP_CACHE_LOOKUPS.inc("fresh")
+        return True
+
+    @staticmethod
+    def get_validators(entry: CachedResponse) -> Dict[str, str]:
+        """
+        :return: The headers that make a request for the cached response conditional
+        """
+        headers = {}
+
+        if entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+
+        if entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+
+        return headers
+
+    @staticmethod
+    def record_not_modified():
+        HTTP_CACHE_LOOKUPS.inc("not_modified")
+
+    def store(self, key: str, headers: Mapping[str, str], body: bytes):
+        cache_control = headers.get("Cache-Control", "").lower()
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        HTTP_CACHE_LOOKUPS.inc("miss")
+
+        max_age_match = MAX_AGE_PATTERN.search(cache_control)
+        max_age = 0
+
+        if max_age_match is not None and "no-cache" not in cache_control:
+            max_age = int(max_age_match.group(1)) - int(headers.get("Age", "0") or 0)
+
+        if (
+            "no-store" in cache_control
+            or len(body) > self.max_size
+            or (etag is None and last_modified is None and max_age <= 0)
+        ):
+            self.remove(key)
+            return
+
+        entry = CachedResponse(
+            body,
+            {"Content-Type": headers.get("Content-Type", "")},
+            etag,
+            last_modified,
+            self.clock() + max_age,
+        )
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+
+            if previous is not None:
+                self.size -= len(previous.body)
+
+            self.entries[key] = entry
+            self.size += len(body)
+
+            while self.size > self.max_size:
+                self.size -= len(self.entries.popitem(last=False)[1].body)
+
+    def remove(self, key: str):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is not None:
+                self.size -= len(entry.body)
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    Transport adapter that sends the GET requests of a requests session through an HttpCache
+    """
+
+    def __init__(self, cache: HttpCache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if request.method != "GET" or kwargs.get("stream"):
+            return super().send(request, **kwargs)
+
+        key = get_cache_key(request.url, request.headers.get("Authorization"))
+        entry = self.cache.get(key)
+
+        if entry is not None:
+            if self.cache.is_fresh(entry):
+                return self.build_cached_response(request, entry)
+
+            # A 304 is answered from this entry, as it may be evicted during the request
+            request.headers.update(self.cache.get_validators(entry))
+
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            # Read the empty body, so closing releases the connection to the pool instead
+            # of closing it
+            response.content
+            response.close()
+            self.cache.record_not_modified()
+            return self.build_cached_response(request, entry)
+        elif response.status_code == 200:
+            self.cache.store(key, response.headers, response.content)
+
+        return response
+
+    @staticmethod
+    def build_cached_response(
+        request: requests.PreparedRequest, entry: CachedResponse
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(entry.headers)
+        response._content = entry.body
+        response.url = request.url
+        response.request = request
+        return response
@@ -0,0 +1,23 @@
+from io import BytesIO
+
+from PIL import Image
+
+
+def decode_cover(data: bytes, min_size: int) -> Image.Image:
+    """
+    Decode a cover to an RGB image. JPEGs are decoded directly at the smallest scale that
+    keeps both edges at least min_size pixels long.
+    :param data: The encoded image
+    :param min_size: The minimum edge length in pixels
+    :return: The decoded RGB image, shared by all analysis steps
+    """
+    image = Image.open(BytesIO(data))
+
+    if image.format == "JPEG":
+        image.draft("RGB", (min_size, min_size))
+
+    if image.mode != "RGB":
+        return image.convert("RGB")
+
+    image.load()
+    return image
@@ -1,5 +1,16 @@
 import logging
 
+from metrics import LOG_MESSAGES
+
+
+class MetricsHandler(logging.Handler):
+    """
+    Counts the logged messages by level
+    """
+
+    def emit(self, record: logging.LogRecord):
+        LOG_MESSAGES.inc(record.levelname.lower())
+
 
 def get_logger(name):
     """
@@ -17,5 +28,6 @@ def get_logger(name):
     )
 
     logger.addHandler(ch)
+    logger.addHandler(MetricsHandler())
 
     return logger
@@ -1,18 +1,71 @@
 import json
+import re
+import sys
+import time
+
+# Startup phases are timed from here, before the dependencies are imported
+STARTUP_TIME = time.monotonic()
+
+from concurrent.futures import Executor, Future
 from datetime import datetime, timedelta
-from io import BytesIO
-from typing import Tuple, List
+from functools import partial, lru_cache
+from threading import Thread, RLock
+from typing import Tuple, List, Optional, NamedTuple, Callable, TypeVar, Dict, Union
 
 import requests
-from PIL import Image
+from apscheduler.events import EVENT_JOB_MISSED, JobExecutionEvent
+from apscheduler.job import Job
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.base import BaseScheduler
 from apscheduler.schedulers.blocking import BlockingScheduler
-from colorthief import ColorThief
 from packaging.version import Version
-from spotipy import util, Spotify
+from spotipy import util, Spotify, SpotifyOAuth, CacheFileHandler, SpotifyException
 
-from colorfinder import ColorFinder, color_filter_hue, color_filter_hue_brightness
+from analysiscache import AnalysisCache, CoverAnalysis
+from analysisworker import (
+    AnalysisWorker,
+    AnalysisQueueFullError,
+    InlineAnalysisWorker,
+    get_result,
+)
 from config import Config
-from homie import HomieDevice, HomieNode, HomieProperty, HomieDataType
+from governor import RequestGovernor, RequestDeferredError, parse_retry_after
+from httpcache import HttpCache, CachingAdapter
+from playback import (
+    PlaybackSnapshot,
+    PlaybackChange,
+    diff_playback,
+    select_cover_url,
+    strip_available_markets_hook,
+)
+from homie import (
+    HomieDevice,
+    HomieNode,
+    HomieProperty,
+    HomieDataType,
+    HomiePublisher,
+    HomiePublishPolicy,
+    HomieExtension,
+    DelayedCall,
+    start_timer,
+)
+from logger import get_logger
+from metrics import (
+    REGISTRY,
+    STAGE_SECONDS,
+    TRACK_CHANGE_DELAY_SECONDS,
+    SPOTIFY_REQUESTS,
+    SPOTIFY_RATE_LIMITED,
+    SPOTIFY_REQUESTS_DEFERRED,
+    ANALYSIS_CACHE_LOOKUPS,
+    SCHEDULER_MISFIRES,
+    STARTUP_SECONDS,
+    get_uptime,
+    start_metrics_server,
+)
+from polling import PollingPolicy
+from statestore import StateStore, PlayerState
+from transition import TransitionStreamer
 import paho.mqtt.client as mqtt
 
 
@@ -23,44 +76,378 @@ def format_seconds(seconds):
     return "{:02}:{:02}:{:03}".format(minutes, num_seconds, milliseconds)
 
 
-class ColorScheduler:
-    mqttc: mqtt.Client
-    homie_device: HomieDevice
+SPOTIFY_SCOPE = "user-read-playback-state"
 
-    def __init__(self):
-        self.scheduler = BlockingScheduler()
-        # self.color_finder = ColorFinder(color_filter_hue)
-        self.color_finder = ColorFinder(color_filter_hue_brightness)
-        self.current_track = None
+LEGACY_STATS_EXTENSION = HomieExtension(
+    "org.homie.legacy-stats", Version("0.1.1"), ("4.x",)
+)
 
-        self.init_mqtt()
-        self.init_homie_device()
+# Governed requests per poll of an account the default budget allows for, the poll itself
+# and a queue request of the prefetch
+REQUESTS_PER_POLL = 2
 
-        self.scheduler.add_job(
-            self.update_job, "interval", (), id="job_updater", seconds=5
+T = TypeVar("T")
+
+logger = get_logger("SpotiBridge")
+
+
+def record_startup_phase(phase: str):
+    """
+    Record the seconds since the start when a startup phase is finished the first time
+    :param phase: One of "import", "init" or "first_publish"
+    """
+    if STARTUP_SECONDS.get(phase) > 0:
+        return
+
+    seconds = time.monotonic() - STARTUP_TIME
+    STARTUP_SECONDS.set(seconds, phase)
+    logger.info(f"Startup phase {phase} finished after {seconds:.3f}s")
+
+
+def record_spotify_request(endpoint: str, status: Union[int, str]):
+    SPOTIFY_REQUESTS.inc(endpoint, str(status))
+
+    if status == 429:
+        SPOTIFY_RATE_LIMITED.inc(endpoint)
+
+
+def get_request_rate(number_of_accounts: int) -> float:
+    """
+    :return: The configured requests per second, by default enough for the polls of all
+    accounts every POLL_INTERVAL seconds
+    """
+    polls_per_second = number_of_accounts / Config.POLL_INTERVAL
+
+    if Config.SPOTIFY_REQUEST_RATE is None:
+        return max(1.0, REQUESTS_PER_POLL * polls_per_second)
+
+    if Config.SPOTIFY_REQUEST_RATE < polls_per_second:
+        logger.warning(
+            f"SPOTIFY_REQUEST_RATE of {Config.SPOTIFY_REQUEST_RATE} is below the "
+            f"{polls_per_second:.2f} polls per second of {number_of_accounts} accounts, "
+            f"polls will be skipped"
         )
 
-    def on_connect(self, client, userdata, flags, rc, properties=None):
-        self.homie_device.publish_config()
+    return Config.SPOTIFY_REQUEST_RATE
 
-    def init_mqtt(self):
-        self.mqttc = mqtt.Client()
 
-        if Config.MQTT_USER is not None:
-            self.mqttc.username_pw_set(Config.MQTT_USER, Config.MQTT_PASSWORD)
+@lru_cache(maxsize=None)
+def get_request_governor(client_id: Optional[str]) -> RequestGovernor:
+    """
+    :return: The governor shared by all Spotify clients of a client id
+    """
+    governor = RequestGovernor(
+        get_request_rate(len(get_spotify_accounts())),
+        Config.SPOTIFY_REQUEST_BURST,
+        Config.SPOTIFY_BACKOFF_BASE,
+        Config.SPOTIFY_BACKOFF_MAX,
+    )
+    REGISTRY.function_gauge(
+        "spotibridge_spotify_backoff_seconds",
+        "Seconds until the governor sends Spotify requests again after a 429 or 5xx",
+        governor.get_backoff,
+    )
+    REGISTRY.function_gauge(
+        "spotibridge_spotify_request_budget",
+        "Spotify requests that can be sent right away within the budget",
+        governor.get_tokens,
+    )
+    return governor
 
-        self.mqttc.on_connect = self.on_connect
 
-        self.mqttc.connect(Config.MQTT_HOST)
-        self.mqttc.loop_start()
+def record_track_change(playback: PlaybackSnapshot, received: float):
+    """
+    Observe how long after the start of a track its colors have been published
+    :param playback: The playback the colors have been published for
+    :param received: time.monotonic() when the playback has been received
+    """
+    TRACK_CHANGE_DELAY_SECONDS.observe(
+        playback.progress_ms / 1000 + time.monotonic() - received
+    )
+
+
+class SpotifyClient:
+    """
+    Long-lived Spotify client that keeps the OAuth token in memory, refreshes it shortly
+    before it expires and uses one keep-alive HTTP session for API calls and cover downloads.
+    """
+
+    def __init__(
+        self,
+        username: str,
+        session: requests.Session,
+        refresh_margin: float = 60,
+        governor: Optional[RequestGovernor] = None,
+    ):
+        self.username = username
+        self.refresh_margin = refresh_margin
+        self.session = session
+        self.governor = (
+            governor
+            if governor is not None
+            else get_request_governor(Config.SPOTIFY_CLIENT_ID)
+        )
+        self.cache_handler = CacheFileHandler(username=username)
+        self.oauth = SpotifyOAuth(
+            client_id=Config.SPOTIFY_CLIENT_ID,
+            client_secret=Config.SPOTIFY_CLIENT_SECRET,
+            redirect_uri=Config.SPOTIFY_REDIRECT_URI,
+            scope=SPOTIFY_SCOPE,
+            cache_handler=self.cache_handler,
+            requests_session=self.session,
+        )
+        self.token_info: Optional[dict] = None
+        self.spotify: Optional[Spotify] = None
+
+    def load_token(self) -> dict:
+        token_info = self.cache_handler.get_cached_token()
+
+        if token_info is None:
+            # Fall back to the interactive flow which stores the token in the cache file
+            util.prompt_for_user_token(
+                self.username,
+                SPOTIFY_SCOPE,
+                client_id=Config.SPOTIFY_CLIENT_ID,
+                client_secret=Config.SPOTIFY_CLIENT_SECRET,
+                redirect_uri=Config.SPOTIFY_REDIRECT_URI,
+            )
+            token_info = self.cache_handler.get_cached_token()
+
+        return token_info
+
+    def needs_token_refresh(self) -> bool:
+        return (
+            self.token_info is None
+            or self.token_info["expires_at"] - time.time() < self.refresh_margin
+        )
+
+    def get_access_token(self) -> str:
+        if self.token_info is None:
+            self.token_info = self.load_token()
+            self.spotify = None
+
+        if self.needs_token_refresh():
+            refresh_token = self.token_info["refresh_token"]
+            self.token_info = self.request(
+                "token", lambda: self.oauth.refresh_access_token(refresh_token)
+            )
+            self.spotify = None
+
+        return self.token_info["access_token"]
+
+    def request(
+        self, endpoint: str, function: Callable[[], T], governed: bool = True
+    ) -> T:
+        """
+        Run a request and record its duration and status
+        :param governed: Whether the request is part of the budget of the client id and its
+        failures back off, False for the cover downloads from the CDN
+        :raise RequestDeferredError: If the governor holds back the request
+        """
+        if governed:
+            self.governor.acquire(endpoint)
+
+        with STAGE_SECONDS.time(endpoint):
+            try:
+                result = function()
+            except SpotifyException as ex:
+                self.record_failure(endpoint, governed, ex.http_status, ex.headers)
+                raise
+            except requests.HTTPError as ex:
+                self.record_failure(
+                    endpoint,
+                    governed,
+                    ex.response.status_code,
+                    ex.response.headers,
+                )
+                raise
+            except Exception:
+                record_spotify_request(endpoint, "error")
+                raise
+
+        record_spotify_request(endpoint, "ok")
+
+        if governed:
+            self.governor.on_response(200)
+
+        return result
+
+    def record_failure(self, endpoint: str, governed: bool, status: int, headers):
+        record_spotify_request(endpoint, status)
+
+        if governed:
+            self.governor.on_response(
+                status, parse_retry_after(headers.get("Retry-After"))
+            )
+
+    def get_spotify(self) -> Spotify:
+        access_token = self.get_access_token()
+
+        if self.spotify is None:
+            self.spotify = Spotify(auth=access_token, requests_session=self.session)
+
+        return self.spotify
+
+    def current_user_playing_track(self) -> Optional[dict]:
+        spotify = self.get_spotify()
+        return self.request("playback", spotify.current_user_playing_track)
+
+    def queue(self) -> Optional[dict]:
+        spotify = self.get_spotify()
+        return self.request("queue", spotify.queue)
+
+    def get_cover(self, cover_url: str) -> bytes:
+        return self.request("cover", lambda: self.download(cover_url), governed=False)
+
+    def download(self, url: str) -> bytes:
+        response = self.session.get(url)
+        response.raise_for_status()
+        return response.content
+
+
+class SpotifyAccount(NamedTuple):
+    username: str
+    device_id: str
+    name: str
+
+
+def get_spotify_accounts() -> List[SpotifyAccount]:
+    """
+    Parse the configured Spotify accounts. SPOTIFY_ACCOUNTS is a comma separated list of
+    usernames, each optionally followed by "=<device id>". Without it the single account of
+    SPOTIFY_USERNAME is published as the device "spotibridge".
+    :return: The accounts to bridge
+    :raise ValueError: If an entry has no username, an invalid or a duplicate device id
+    """
+    if Config.SPOTIFY_ACCOUNTS is None:
+        return [SpotifyAccount(Config.SPOTIFY_USERNAME, "spotibridge", "Spotibridge")]
+
+    accounts = []
+    device_ids = set()
+
+    for entry in Config.SPOTIFY_ACCOUNTS.split(","):
+        username, separator, device_id = entry.strip().partition("=")
+
+        if not username:
+            raise ValueError(f"SPOTIFY_ACCOUNTS entry {entry!r} has no username")
+
+        if not separator:
+            device_id = "spotibridge-" + re.sub(r"[^a-z0-9]+", "-", username.lower())
+            device_id = device_id.strip("-")
+
+        # Homie ids consist of lowercase letters, digits and hyphens
+        if not re.fullmatch(r"[a-z0-9]+(-[a-z0-9]+)*", device_id):
+            raise ValueError(
+                f"SPOTIFY_ACCOUNTS entry {entry!r} has the invalid device id {device_id!r}"
+            )
+
+        if device_id in device_ids:
+            raise ValueError(
+                f"SPOTIFY_ACCOUNTS entry {entry!r} reuses the device id {device_id!r}"
+            )
+
+        device_ids.add(device_id)
+        accounts.append(SpotifyAccount(username, device_id, f"Spotibridge {username}"))
+
+    return accounts
+
 
-    def init_homie_device(self):
-        homie_device = HomieDevice("spotibridge", self.mqttc)
-        homie_device.name = "Spotibridge"
+class CoverRequest(NamedTuple):
+    track_id: str
+    album_id: str
+    cover_url: str
+
+
+class PrefetchedTrack(NamedTuple):
+    previous_track_id: str
+    track_id: str
+    title: str
+    analysis: CoverAnalysis
+
+
+def get_next_queued_track(queue: Optional[dict]) -> Optional[dict]:
+    """
+    Return the upcoming track of a playback queue response if its cover can be analysed
+    :param queue: The response of the playback queue endpoint
+    :return: The track object or None
+    """
+    if queue is None or not queue.get("queue"):
+        return None
+
+    next_track = queue["queue"][0]
+
+    if next_track.get("type") != "track" or not next_track["album"]["images"]:
+        return None
+
+    return next_track
+
+
+def create_cover_analyser():
+    # numpy and Pillow are only imported once the first cover is analysed, or by the
+    # worker processes, so they do not delay the start
+    from coveranalyser import CoverAnalyser
+
+    return CoverAnalyser()
+
+
+class SpotifyPlayer:
+    """
+    State and homie device of one Spotify account. The runtimes request the playback state
+    and analyse the covers, while the player decides what has to be published. The state is
+    changed under the lock, as results of analyses arrive on other threads than the polls.
+    """
+
+    homie_device: HomieDevice
+
+    def __init__(
+        self,
+        device_id: str,
+        name: str,
+        spotify_client: SpotifyClient,
+        mqtt_client: mqtt.Client,
+        publisher: HomiePublisher,
+        transition_streamer: Optional[TransitionStreamer] = None,
+        state_store: Optional[StateStore] = None,
+    ):
+        self.device_id = device_id
+        self.name = name
+        self.spotify_client = spotify_client
+        self.transition_streamer = transition_streamer
+        self.state_store = state_store
+        self.lock = RLock()
+        self.current_track = None
+        self.next_change = None
+        self.prefetch_track = None
+        self.prefetched_track: Optional[PrefetchedTrack] = None
+        # Cover of the current track whose analysis could not be queued yet
+        self.deferred_cover: Optional[CoverRequest] = None
+        # Palette of the album-cover-palette property, which holds it serialised
+        self.palette: List[Tuple[int, int, int]] = []
+        # The last handled playback, None while stopped, and when it has been received
+        self.playback: Optional[PlaybackSnapshot] = None
+        self.playback_time: Optional[datetime] = None
+        self.polling_policy = PollingPolicy(
+            Config.POLL_MIN_INTERVAL,
+            Config.POLL_MAX_INTERVAL,
+            Config.POLL_BOUNDARY_WINDOW,
+            Config.POLL_IDLE_MAX_INTERVAL,
+        )
+
+        self.init_homie_device(mqtt_client, publisher)
+
+        if state_store is not None:
+            self.restore_state(state_store.get(device_id))
+
+    def init_homie_device(self, mqtt_client: mqtt.Client, publisher: HomiePublisher):
+        homie_device = HomieDevice(self.device_id, mqtt_client, publisher)
+        homie_device.name = self.name
         homie_device.implementation = "SpotiBridge"
         homie_device.version = Version("4.0.0")
         homie_device.extensions = set()
 
+        if Config.HOMIE_STATS:
+            homie_device.extensions.add(LEGACY_STATS_EXTENSION)
+
         node = HomieNode("player", homie_device, True)
         node.name = "Player"
         node.type = "player"
@@ -88,125 +475,893 @@ class ColorScheduler:
         album_cover_palette_property.datatype = HomieDataType.STRING
         album_cover_palette_property.value = "[]"
 
+        publish_policy = HomiePublishPolicy(min_interval=Config.PROPERTY_MIN_INTERVAL)
+
+        for homie_property in node.properties.values():
+            homie_property.set_publish_policy(publish_policy)
+
+        if self.transition_streamer is not None:
+            transition_node = HomieNode("transition", homie_device, True)
+            transition_node.name = "Color transition"
+            transition_node.type = "color-stream"
+
+            transition_color_property = HomieProperty("color", transition_node, True)
+            transition_color_property.name = "Color"
+            transition_color_property.datatype = HomieDataType.COLOR
+            transition_color_property.format = "rgb"
+            transition_color_property.retained = False
+            transition_color_property.value = (0, 0, 0)
+
+            self.transition_streamer.add_stream(
+                self.device_id, transition_color_property
+            )
+
         self.homie_device = homie_device
 
-    def start(self):
-        self.scheduler.start()
+    def restore_state(self, state: Optional[PlayerState]):
+        """
+        Set the properties to a snapshot before they are published for the first time
+        """
+        if state is None:
+            return
 
-    def get_color_palette(self, image: Image) -> List[Tuple[int, int, int]]:
-        color_thief = ColorThief(image)
-        palette = color_thief.get_palette(5, 1)
-        return palette
-
-    def set_color_palette(self, palette: List[Tuple[int, int, int]]):
-        color_palette_property = self.homie_device.nodes["player"].properties[
-            "album-cover-palette"
-        ]
-        current_value = color_palette_property.value
-        color_palette_property.value = json.dumps(palette)
-
-        if current_value != color_palette_property.value:
-            color_palette_property.publish_value()
-
-    def update_job(self):
-        def update_color_caller():
-            self.set_color((0, 0, 0))
-            self.set_color_palette([])
-
-        token = util.prompt_for_user_token(
-            Config.SPOTIFY_USERNAME,
-            "user-read-playback-state",
-            client_id=Config.SPOTIFY_CLIENT_ID,
-            client_secret=Config.SPOTIFY_CLIENT_SECRET,
-            redirect_uri=Config.SPOTIFY_REDIRECT_URI,
+        self.current_track = state.current_track
+        self.palette = state.palette
+        properties = self.homie_device.nodes["player"].properties
+        properties["is-playing"].value = state.is_playing
+        properties["track"].value = state.title
+        properties["dominant-album-color"].value = state.color
+        properties["album-cover-palette"].value = json.dumps(state.palette)
+
+        if self.transition_streamer is not None:
+            transition_node = self.homie_device.nodes["transition"]
+            transition_node.properties["color"].value = state.color
+            self.transition_streamer.set_colors(
+                self.device_id, state.color, state.palette, fade=False
+            )
+
+    def save_state(self):
+        # Estimates are not saved, as a restored track is not analysed again
+        if self.state_store is None:
+            return
+
+        properties = self.homie_device.nodes["player"].properties
+        self.state_store.put(
+            self.device_id,
+            PlayerState(
+                self.current_track,
+                properties["track"].value,
+                properties["is-playing"].value,
+                tuple(properties["dominant-album-color"].value),
+                [tuple(color) for color in self.palette],
+            ),
         )
 
-        sp = Spotify(auth=token)
+    def handle_stopped(self, track_end_pending: bool):
+        self.playback = None
+        self.deferred_cover = None
+        self.next_change = None
+        self.prefetch_track = None
+        self.prefetched_track = None
+
+        if track_end_pending or self.current_track is not None:
+            self.current_track = None
+
+            with self.homie_device.batch():
+                self.set_colors((0, 0, 0), [])
+                self.set_is_playing(False)
+                self.set_current_track_title("")
 
-        current_track = sp.current_user_playing_track()
+            self.save_state()
 
+    def get_playback_changes(
+        self, playback: Optional[PlaybackSnapshot], now: datetime
+    ) -> PlaybackChange:
+        """
+        Compare a playback with the last handled one
+        """
         if (
-            current_track is None
-            or not current_track["is_playing"]
-            or current_track["item"] is None
+            playback is None
+            and self.playback is None
+            and self.current_track is not None
         ):
-            job = self.scheduler.get_job("color_updater")
+            # Nothing was polled since a playing state was restored
+            return PlaybackChange.PLAYING
 
-            if job is not None:
-                job.remove()
+        elapsed_ms = 0.0
 
-            if job is not None or self.current_track is not None:
-                self.set_color((0, 0, 0))
-                self.set_color_palette([])
-                self.set_is_playing(False)
-                self.set_current_track_title("")
+        if self.playback_time is not None:
+            elapsed_ms = (now - self.playback_time).total_seconds() * 1000
 
-            return
+        changes = diff_playback(
+            self.playback, playback, elapsed_ms, Config.PLAYBACK_PROGRESS_TOLERANCE
+        )
+
+        # A started playback is compared with the track that was published last
+        if playback is not None and playback.track_id != self.current_track:
+            changes |= PlaybackChange.TRACK
+
+        return changes
+
+    def set_playback(self, playback: PlaybackSnapshot, now: datetime):
+        self.playback = playback
+        self.playback_time = now
+
+    def handle_track_change(
+        self, playback: PlaybackSnapshot
+    ) -> Optional[Tuple[str, str]]:
+        """
+        Update the state for another track
+        :return: The album id and cover url if the cover of a new track has to be published
+        """
+        if self.current_track == playback.track_id:
+            return None
+
+        self.current_track = playback.track_id
+        self.deferred_cover = None
+
+        return playback.album_id, select_cover_url(
+            playback.images, Config.COVER_MIN_SIZE
+        )
+
+    def defer_cover(self, cover: CoverRequest):
+        """
+        Keep a cover whose analysis could not be queued, to submit it on the next poll
+        """
+        with self.lock:
+            if self.current_track == cover.track_id:
+                self.deferred_cover = cover
+
+    def take_deferred_cover(self) -> Optional[CoverRequest]:
+        cover, self.deferred_cover = self.deferred_cover, None
+        return cover
+
+    def publish_track(self, analysis: CoverAnalysis, title: str):
+        with STAGE_SECONDS.time("publish"), self.homie_device.batch():
+            self.set_colors(analysis.color, analysis.palette)
+            self.set_current_track_title(title)
+
+        self.save_state()
+
+    def publish_estimate(self, track_id: str, color: Tuple[int, int, int], title: str):
+        """
+        Publish the estimated color of a track whose cover is still being analysed
+        """
+        with self.lock:
+            if self.current_track != track_id:
+                return
+
+            with self.homie_device.batch():
+                self.set_colors(color, [color])
+                self.set_current_track_title(title)
+
+    def publish_analysed_track(
+        self, track_id: str, analysis: CoverAnalysis, title: str
+    ) -> bool:
+        """
+        Publish a track whose cover has been analysed in the background
+        :return: False if another track is playing by now and nothing was published
+        """
+        with self.lock:
+            if self.current_track != track_id:
+                return False
+
+            self.publish_track(analysis, title)
+            return True
+
+    def publish_stats(self, stats: Dict[str, str]):
+        for name, value in stats.items():
+            self.homie_device.publish_additional_attribute(["$stats", name], value)
+
+    def update_next_change(self, playback: PlaybackSnapshot, now: datetime) -> datetime:
+        # One cannot use the timestamp of the response as it is not correct
+        start_of_track = now - timedelta(milliseconds=playback.progress_ms)
+        self.next_change = start_of_track + timedelta(milliseconds=playback.duration_ms)
+
+        return self.next_change
 
-        track_id = current_track["item"]["id"]
+    def needs_prefetch(self, prefetch_pending: bool) -> bool:
+        # Prefetch once per track, but follow seeks until the prefetch has run
+        return Config.PREFETCH and (
+            self.prefetch_track != self.current_track or prefetch_pending
+        )
+
+    def get_prefetch_time(self, now: datetime) -> datetime:
+        self.prefetch_track = self.current_track
+        return max(now, self.next_change - timedelta(seconds=Config.PREFETCH_LOOKAHEAD))
 
-        if self.current_track is None:
-            self.set_is_playing(True)
+    def set_prefetched_track(
+        self, previous_track_id: str, track: dict, analysis: CoverAnalysis
+    ):
+        with self.lock:
+            self.prefetched_track = PrefetchedTrack(
+                previous_track_id=previous_track_id,
+                track_id=track["id"],
+                title=track["name"],
+                analysis=analysis,
+            )
 
-        if self.current_track != track_id:
-            self.current_track = track_id
+    def handle_track_end(self):
+        with self.lock:
+            prefetched_track = self.prefetched_track
 
-            cover_urls = current_track["item"]["album"]["images"]
-            cover_url = cover_urls[0]["url"]
+            if (
+                prefetched_track is not None
+                and prefetched_track.previous_track_id == self.current_track
+            ):
+                # Publish the already analysed upcoming track right at the boundary
+                self.current_track = prefetched_track.track_id
+                self.publish_track(prefetched_track.analysis, prefetched_track.title)
+            else:
+                self.set_colors((0, 0, 0), [])
+                self.save_state()
 
-            response = requests.get(cover_url)
-            response.raise_for_status()
-            image = Image.open(BytesIO(response.content))
+    def set_colors(
+        self, color: Tuple[int, int, int], palette: List[Tuple[int, int, int]]
+    ):
+        properties = self.homie_device.nodes["player"].properties
+        changed = properties["dominant-album-color"].update_value(color)
 
-            self.set_color(self.color_finder.get_most_prominent_color(image))
-            self.set_color_palette(self.get_color_palette(image))
-            self.set_current_track_title(current_track["item"]["name"])
+        # Compare the palettes before serialising them
+        if palette != self.palette:
+            self.palette = palette
+            changed |= properties["album-cover-palette"].update_value(
+                json.dumps(palette)
+            )
 
-        # One cannot use this as this is not correct
-        # now = datetime.fromtimestamp(current_track['timestamp'] / 1000)
+        if changed and self.transition_streamer is not None:
+            self.transition_streamer.set_colors(
+                self.device_id,
+                color,
+                [tuple(palette_color) for palette_color in palette],
+            )
 
-        now = datetime.now()
+    def set_is_playing(self, is_playing: bool):
+        self.homie_device.nodes["player"].properties["is-playing"].update_value(
+            is_playing
+        )
 
-        start_of_track = now - timedelta(milliseconds=current_track["progress_ms"])
-        next_change = start_of_track + timedelta(
-            milliseconds=current_track["item"]["duration_ms"]
+    def set_current_track_title(self, current_track_title: str):
+        self.homie_device.nodes["player"].properties["track"].update_value(
+            current_track_title
         )
 
+
+def get_estimate_publisher(
+    player: SpotifyPlayer, playback: PlaybackSnapshot
+) -> Optional[Callable[[Tuple[int, int, int]], None]]:
+    if not Config.PROGRESSIVE:
+        return None
+
+    return partial(player.publish_estimate, playback.track_id, title=playback.title)
+
+
+def create_mqtt_client() -> mqtt.Client:
+    mqttc = mqtt.Client()
+
+    if Config.MQTT_USER is not None:
+        mqttc.username_pw_set(Config.MQTT_USER, Config.MQTT_PASSWORD)
+
+    return mqttc
+
+
+def create_session() -> requests.Session:
+    session = requests.Session()
+    session.hooks["response"].append(strip_available_markets_hook)
+
+    if Config.HTTP_CACHE_SIZE > 0:
+        adapter = CachingAdapter(HttpCache(Config.HTTP_CACHE_SIZE))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    return session
+
+
+def create_publisher(
+    mqtt_client: mqtt.Client,
+    call_later: Callable[[float, Callable[[], None]], DelayedCall] = start_timer,
+) -> HomiePublisher:
+    publisher = HomiePublisher(mqtt_client, Config.MQTT_MAX_IN_FLIGHT, call_later)
+    publisher.register()
+    REGISTRY.function_counter(
+        "spotibridge_mqtt_messages_total",
+        "Messages handed to the MQTT client",
+        lambda: publisher.sent_count,
+    )
+    return publisher
+
+
+def get_homie_stats(
+    publisher: HomiePublisher, governor: RequestGovernor
+) -> Dict[str, str]:
+    """
+    Return the process wide statistics in the format of the homie legacy-stats extension
+    """
+    return {
+        "interval": str(int(Config.HOMIE_STATS_INTERVAL)),
+        "uptime": str(int(get_uptime())),
+        "spotify-requests": str(int(SPOTIFY_REQUESTS.get_total())),
+        "rate-limited": str(int(SPOTIFY_RATE_LIMITED.get_total())),
+        "deferred-requests": str(int(SPOTIFY_REQUESTS_DEFERRED.get_total())),
+        "spotify-backoff": str(round(governor.get_backoff())),
+        "cache-hits": str(
+            int(
+                ANALYSIS_CACHE_LOOKUPS.get("memory")
+                + ANALYSIS_CACHE_LOOKUPS.get("disk")
+            )
+        ),
+        "cache-misses": str(int(ANALYSIS_CACHE_LOOKUPS.get("miss"))),
+        "mqtt-messages": str(publisher.sent_count),
+        "misfires": str(int(SCHEDULER_MISFIRES.get_total())),
+        "track-change-delay": f"{TRACK_CHANGE_DELAY_SECONDS.get_last():.2f}",
+    }
+
+
+def create_analysis_worker(
+    inline_executor: Optional[Executor] = None,
+) -> Union[AnalysisWorker, InlineAnalysisWorker]:
+    """
+    :param inline_executor: Runs the analyses if ANALYSIS_WORKERS is 0, instead of the
+    polling thread
+    """
+    if Config.ANALYSIS_WORKERS == 0:
+        return InlineAnalysisWorker(create_cover_analyser, inline_executor)
+
+    return AnalysisWorker(
+        create_cover_analyser, Config.ANALYSIS_WORKERS, Config.ANALYSIS_MAX_PENDING
+    )
+
+
+def create_state_store() -> Optional[StateStore]:
+    if Config.STATE_SNAPSHOT_PATH is None:
+        return None
+
+    return StateStore(Config.STATE_SNAPSHOT_PATH)
+
+
+def create_transition_streamer() -> Optional[TransitionStreamer]:
+    if not Config.TRANSITION_STREAM:
+        return None
+
+    return TransitionStreamer(
+        Config.TRANSITION_FRAME_RATE,
+        Config.TRANSITION_DURATION,
+        Config.TRANSITION_PALETTE_HOLD if Config.TRANSITION_PALETTE_CYCLE else None,
+    )
+
+
+def create_players(
+    mqtt_client: mqtt.Client,
+    publisher: HomiePublisher,
+    session: requests.Session,
+    transition_streamer: Optional[TransitionStreamer] = None,
+    accounts: Optional[List[SpotifyAccount]] = None,
+    create_spotify_client: Callable[..., SpotifyClient] = SpotifyClient,
+    state_store: Optional[StateStore] = None,
+) -> List[SpotifyPlayer]:
+    if accounts is None:
+        accounts = get_spotify_accounts()
+
+    return [
+        SpotifyPlayer(
+            account.device_id,
+            account.name,
+            create_spotify_client(account.username, session),
+            mqtt_client,
+            publisher,
+            transition_streamer,
+            state_store,
+        )
+        for account in accounts
+    ]
+
+
+def get_poll_offset(index: int, number_of_players: int) -> float:
+    # Spread the polls of all players evenly across the poll interval
+    return index * Config.POLL_INTERVAL / number_of_players
+
+
+class ScheduledCall(NamedTuple):
+    job: Job
+
+    def cancel(self):
+        try:
+            self.job.remove()
+        except JobLookupError:
+            # Already run
+            pass
+
+
+class BaseColorScheduler:
+    """
+    The part of the runtimes that decides what happens for a polled playback: the players,
+    the analyses of their covers, the timers of the track ends and prefetches and what is
+    published. The runtimes poll, download, and run the timers of set_timer.
+    """
+
+    mqttc: mqtt.Client
+
+    def __init__(
+        self,
+        mqtt_client: mqtt.Client,
+        session: requests.Session,
+        accounts: Optional[List[SpotifyAccount]] = None,
+        create_spotify_client: Callable[..., SpotifyClient] = SpotifyClient,
+        now: Callable[[], datetime] = datetime.now,
+        call_later: Callable[[float, Callable[[], None]], DelayedCall] = start_timer,
+        inline_executor: Optional[Executor] = None,
+    ):
+        """
+        :param session: HTTP session of the Spotify clients
+        :param call_later: Runs the delayed publishes of the homie properties
+        :param inline_executor: Runs the analyses if they are not done in worker processes
+        """
+        self.analysis_worker = create_analysis_worker(inline_executor)
+        # Created for the first estimate
+        self.cover_analyser = None
+        self.now = now
+        self.governor = get_request_governor(Config.SPOTIFY_CLIENT_ID)
+        self.analysis_cache = AnalysisCache(
+            Config.ANALYSIS_CACHE_PATH,
+            Config.ANALYSIS_CACHE_MEMORY_SIZE,
+            Config.ANALYSIS_CACHE_DISK_SIZE,
+        )
+        self.logger = get_logger(type(self).__name__)
+
+        self.mqttc = mqtt_client
+        self.mqttc.on_connect = self.on_connect
+        self.publisher = create_publisher(self.mqttc, call_later)
+
+        self.session = session
+        self.transition_streamer = create_transition_streamer()
+        self.players = create_players(
+            self.mqttc,
+            self.publisher,
+            self.session,
+            self.transition_streamer,
+            accounts,
+            create_spotify_client,
+            create_state_store(),
+        )
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        # The broker may have lost the retained messages, e.g. after a restart
+        for player in self.players:
+            player.homie_device.publish_config(force=True)
+
+        record_startup_phase("first_publish")
+
+    def publish_stats(self):
+        stats = get_homie_stats(self.publisher, self.governor)
+
+        for player in self.players:
+            player.publish_stats(stats)
+
+    def get_poll_interval(self, player: SpotifyPlayer) -> float:
+        """
+        :return: Seconds until the next poll of a player, within the request budget
+        """
+        if Config.POLL_MODE == "adaptive":
+            interval = player.polling_policy.get_next_interval(
+                self.now(), player.next_change
+            )
+        else:
+            interval = Config.POLL_INTERVAL
+
+        return max(interval, self.governor.get_delay())
+
+    def set_timer(
+        self,
+        name: str,
+        player: SpotifyPlayer,
+        run_date: datetime,
+        callback: Callable,
+        *args,
+    ):
+        """
+        Call a function at a date, replacing the pending timer with the same name
+        """
+        raise NotImplementedError()
+
+    def cancel_timer(self, name: str, player: SpotifyPlayer) -> bool:
+        """
+        :return: True if the timer was pending
+        """
+        raise NotImplementedError()
+
+    def has_timer(self, name: str, player: SpotifyPlayer) -> bool:
+        raise NotImplementedError()
+
+    def start_prefetch(self, player: SpotifyPlayer, track_id: str):
+        """
+        Request the queue and analyse the cover of the next track, called by a timer
+        """
+        raise NotImplementedError()
+
+    def handle_playback(
+        self,
+        player: SpotifyPlayer,
+        playback: Optional[PlaybackSnapshot],
+        now: datetime,
+    ) -> Optional[CoverRequest]:
+        """
+        Update a player and its timers for a polled playback
+        :return: The cover to analyse and publish if a new track is playing
+        """
+        with player.lock:
+            changes = player.get_playback_changes(playback, now)
+
+            if changes == PlaybackChange.NONE:
+                return player.take_deferred_cover()
+
+            if playback is None:
+                self.analysis_worker.cancel(player.device_id)
+                self.cancel_timer("prefetcher", player)
+                player.handle_stopped(self.cancel_timer("color_updater", player))
+                return None
+
+            if PlaybackChange.PLAYING in changes:
+                player.set_is_playing(True)
+
+            cover = None
+
+            # Only another track needs its cover and, via the prefetch, the queue
+            if PlaybackChange.TRACK in changes:
+                cover = player.handle_track_change(playback)
+
+            # Any change, including a seek, moves the end of the track
+            self.set_timer(
+                "color_updater",
+                player,
+                player.update_next_change(playback, now),
+                player.handle_track_end,
+            )
+
+            if player.needs_prefetch(self.has_timer("prefetcher", player)):
+                self.set_timer(
+                    "prefetcher",
+                    player,
+                    player.get_prefetch_time(now),
+                    self.start_prefetch,
+                    player,
+                    player.current_track,
+                )
+
+            player.set_playback(playback, now)
+
+            if cover is None:
+                return player.take_deferred_cover()
+
+            return CoverRequest(player.current_track, *cover)
+
+    def get_cached_analysis(self, album_id: str, cover_url: str) -> Optional[Future]:
+        """
+        :return: A completed future of the cached analysis of a cover or None
+        """
+        analysis = self.analysis_cache.get(album_id, cover_url)
+
+        if analysis is None:
+            return None
+
+        future = Future()
+        future.set_result(analysis)
+        return future
+
+    def analyse_cover(
+        self,
+        key: str,
+        album_id: str,
+        cover_url: str,
+        data: bytes,
+        on_estimate: Optional[Callable[[Tuple[int, int, int]], None]] = None,
+    ) -> Future:
+        """
+        Queue the analysis of a downloaded cover
+        :param key: A new analysis drops the pending analysis with the same key
+        :param on_estimate: Called with an estimated color while the cover is analysed
+        :return: Future of the analysis
+        """
+        future = self.analysis_worker.submit(key, data)
+        future.add_done_callback(partial(self.cache_analysis, album_id, cover_url))
+
+        if on_estimate is not None:
+            on_estimate(self.get_cover_analyser().estimate(data))
+
+        return future
+
+    def get_cover_analyser(self):
+        if self.cover_analyser is None:
+            self.cover_analyser = create_cover_analyser()
+
+        return self.cover_analyser
+
+    def cache_analysis(self, album_id: str, cover_url: str, future: Future):
+        if not future.cancelled() and future.exception() is None:
+            self.analysis_cache.put(album_id, cover_url, future.result())
+
+    @staticmethod
+    def publish_analysed_track(
+        player: SpotifyPlayer,
+        track_id: str,
+        playback: PlaybackSnapshot,
+        received: float,
+        future: Future,
+    ):
+        analysis = get_result(future)
+
+        if analysis is not None and player.publish_analysed_track(
+            track_id, analysis, playback.title
+        ):
+            record_track_change(playback, received)
+
+    @staticmethod
+    def set_prefetched_track(
+        player: SpotifyPlayer, track_id: str, next_track: dict, future: Future
+    ):
+        analysis = get_result(future)
+
+        if analysis is not None:
+            player.set_prefetched_track(track_id, next_track, analysis)
+
+
+class ColorScheduler(BaseColorScheduler):
+    """
+    Runtime that polls the players from the jobs of an APScheduler scheduler and analyses
+    the covers in worker processes
+    """
+
+    def __init__(
+        self,
+        scheduler: Optional[BaseScheduler] = None,
+        mqtt_client: Optional[mqtt.Client] = None,
+        accounts: Optional[List[SpotifyAccount]] = None,
+        create_spotify_client: Callable[..., SpotifyClient] = SpotifyClient,
+        now: Callable[[], datetime] = datetime.now,
+    ):
+        """
+        All arguments are meant for replays, by default the configured accounts are bridged
+        :param scheduler: Scheduler of the jobs, a BlockingScheduler by default
+        :param mqtt_client: Client to publish with, connected to MQTT_HOST by default
+        :param accounts: Accounts to bridge instead of the configured ones
+        :param create_spotify_client: Called with the username and the HTTP session
+        :param now: Returns the current time
+        """
+        self.scheduler = scheduler if scheduler is not None else BlockingScheduler()
+
+        super().__init__(
+            mqtt_client if mqtt_client is not None else create_mqtt_client(),
+            create_session(),
+            accounts,
+            create_spotify_client,
+            now,
+            self.call_later,
+        )
+
+        # Connected by the network thread, which publishes the restored state on connect
+        self.mqttc.connect_async(Config.MQTT_HOST)
+        self.mqttc.loop_start()
+
+        if self.transition_streamer is not None:
+            Thread(
+                target=self.transition_streamer.run, name="transitions", daemon=True
+            ).start()
+
+        self.scheduler.add_listener(self.on_job_missed, EVENT_JOB_MISSED)
+
+        if Config.HOMIE_STATS:
+            self.scheduler.add_job(
+                self.publish_stats,
+                "interval",
+                id="stats_publisher",
+                seconds=Config.HOMIE_STATS_INTERVAL,
+            )
+
+        now = self.now()
+
+        for index, player in enumerate(self.players):
+            start_date = now + timedelta(
+                seconds=get_poll_offset(index, len(self.players))
+            )
+
+            if Config.POLL_MODE == "adaptive":
+                self.scheduler.add_job(
+                    self.poll_job,
+                    "date",
+                    (player,),
+                    id=f"job_updater:{player.device_id}",
+                    run_date=start_date,
+                    misfire_grace_time=None,
+                )
+            else:
+                self.scheduler.add_job(
+                    self.update_job,
+                    "interval",
+                    (player,),
+                    id=f"job_updater:{player.device_id}",
+                    seconds=Config.POLL_INTERVAL,
+                    start_date=start_date,
+                )
+
+    def start(self):
+        self.scheduler.start()
+
+    @staticmethod
+    def on_job_missed(event: JobExecutionEvent):
+        SCHEDULER_MISFIRES.inc(event.job_id.partition(":")[0])
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> ScheduledCall:
+        """
+        Run a delayed publish of the homie properties as a job of the scheduler
+        """
+        return ScheduledCall(
+            self.scheduler.add_job(
+                callback,
+                "date",
+                run_date=self.now() + timedelta(seconds=delay),
+                misfire_grace_time=None,
+            )
+        )
+
+    def set_timer(
+        self,
+        name: str,
+        player: SpotifyPlayer,
+        run_date: datetime,
+        callback: Callable,
+        *args,
+    ):
         self.scheduler.add_job(
-            update_color_caller,
+            callback,
             "date",
-            (),
-            id="color_updater",
-            run_date=next_change,
+            args,
+            id=f"{name}:{player.device_id}",
+            run_date=run_date,
+            misfire_grace_time=None,
             replace_existing=True,
         )
 
-    def set_color(self, color: Tuple[int, int, int]) -> None:
-        color_property = self.homie_device.nodes["player"].properties[
-            "dominant-album-color"
-        ]
+    def cancel_timer(self, name: str, player: SpotifyPlayer) -> bool:
+        return self.remove_job(f"{name}:{player.device_id}")
 
-        if color_property.value != color:
-            color_property.value = color
-            color_property.publish_value()
+    def has_timer(self, name: str, player: SpotifyPlayer) -> bool:
+        return self.scheduler.get_job(f"{name}:{player.device_id}") is not None
 
-    def set_is_playing(self, is_playing: bool):
-        is_playing_property = self.homie_device.nodes["player"].properties["is-playing"]
+    def remove_job(self, job_id: str) -> bool:
+        job = self.scheduler.get_job(job_id)
 
-        if is_playing_property.value != is_playing:
-            is_playing_property.value = is_playing
-            is_playing_property.publish_value()
+        if job is not None:
+            job.remove()
 
-    def set_current_track_title(self, current_track_title: str):
-        current_track_property = self.homie_device.nodes["player"].properties["track"]
+        return job is not None
+
+    def get_cover_analysis(
+        self,
+        key: str,
+        spotify_client: SpotifyClient,
+        album_id: str,
+        cover_url: str,
+        on_estimate: Optional[Callable[[Tuple[int, int, int]], None]] = None,
+    ) -> Future:
+        """
+        Look up the analysis of a cover or download the cover and queue its analysis
+        :return: Future of the analysis
+        """
+        future = self.get_cached_analysis(album_id, cover_url)
 
-        if current_track_property.value != current_track_title:
-            current_track_property.value = current_track_title
-            current_track_property.publish_value()
+        if future is None:
+            future = self.analyse_cover(
+                key,
+                album_id,
+                cover_url,
+                spotify_client.get_cover(cover_url),
+                on_estimate,
+            )
+
+        return future
+
+    def poll_job(self, player: SpotifyPlayer):
+        try:
+            self.update_job(player)
+        finally:
+            self.scheduler.add_job(
+                self.poll_job,
+                "date",
+                (player,),
+                id=f"job_updater:{player.device_id}",
+                run_date=self.now() + timedelta(seconds=self.get_poll_interval(player)),
+                misfire_grace_time=None,
+                replace_existing=True,
+            )
+
+    def start_prefetch(self, player: SpotifyPlayer, track_id: str):
+        try:
+            next_track = get_next_queued_track(player.spotify_client.queue())
+
+            if next_track is None:
+                return
+
+            album = next_track["album"]
+            future = self.get_cover_analysis(
+                f"{player.device_id}:prefetch",
+                player.spotify_client,
+                album["id"],
+                select_cover_url(album["images"], Config.COVER_MIN_SIZE),
+            )
+        except (
+            RequestDeferredError,
+            AnalysisQueueFullError,
+            SpotifyException,
+            requests.RequestException,
+        ) as ex:
+            self.logger.warning(f"Failed to prefetch the next track: {ex}")
+            return
+
+        future.add_done_callback(
+            partial(self.set_prefetched_track, player, track_id, next_track)
+        )
+
+    def update_job(self, player: SpotifyPlayer):
+        try:
+            self.update(player)
+        except RequestDeferredError as ex:
+            self.logger.info(f"Skipped the update of {player.device_id}: {ex}")
+        except (SpotifyException, requests.RequestException) as ex:
+            self.logger.warning(f"Failed to update {player.device_id}: {ex}")
+
+    def update(self, player: SpotifyPlayer):
+        playback = PlaybackSnapshot.from_response(
+            player.spotify_client.current_user_playing_track()
+        )
+        received = time.monotonic()
+        cover = self.handle_playback(player, playback, self.now())
+
+        if cover is not None:
+            # Publish once analysed, without holding up the polls. If the track changes
+            # before, the analysis is dropped in favour of the new track.
+            try:
+                future = self.get_cover_analysis(
+                    player.device_id,
+                    player.spotify_client,
+                    cover.album_id,
+                    cover.cover_url,
+                    on_estimate=get_estimate_publisher(player, playback),
+                )
+            except AnalysisQueueFullError as ex:
+                self.logger.info(f"Deferred the analysis of {player.device_id}: {ex}")
+                player.defer_cover(cover)
+                return
+
+            future.add_done_callback(
+                partial(
+                    self.publish_analysed_track,
+                    player,
+                    cover.track_id,
+                    playback,
+                    received,
+                )
+            )
 
 
 def main():
-    color_scheduler = ColorScheduler()
+    record_startup_phase("import")
+
+    if Config.RUNTIME == "asyncio":
+        # The runtime imports this module, which would otherwise be loaded a second time
+        # with its own start time
+        sys.modules.setdefault("main", sys.modules[__name__])
+
+        from asyncruntime import AsyncColorScheduler
+
+        color_scheduler = AsyncColorScheduler()
+    else:
+        color_scheduler = ColorScheduler()
+
+    record_startup_phase("init")
+
+    # Only now, as the analysis worker processes are forked by the schedulers
+    if Config.METRICS_PORT is not None:
+        start_metrics_server(Config.METRICS_HOST, Config.METRICS_PORT)
+
     color_scheduler.start()
 
 
@@ -0,0 +1,321 @@
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Tuple, Dict, List, Callable, Iterator
+
+# Upper bounds in seconds, suitable for everything from a dict lookup to an API call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+START_TIME = time.monotonic()
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...]) -> str:
+    if not label_names:
+        return ""
+
+    labels = ",".join(
+        f'{name}="{value}"' for name, value in zip(label_names, label_values)
+    )
+    return f"{{{labels}}}"
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.lock = Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+    def get_total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+    def collect(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+
+        with self.lock:
+            for label_values, value in self.values.items():
+                labels = format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}{labels} {value}")
+
+        return lines
+
+
+class Gauge(Counter):
+    """
+    Gauge whose values are set, e.g. durations measured once
+    """
+
+    def set(self, value: float, *label_values: str):
+        with self.lock:
+            self.values[label_values] = value
+
+    def collect(self) -> List[str]:
+        lines = super().collect()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class FunctionCounter:
+    """
+    Counter whose value is read from a function, for counts kept by other components
+    """
+
+    def __init__(self, name: str, description: str, function: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self.function = function
+
+    def get_total(self) -> float:
+        return self.function()
+
+    def collect(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.function()}",
+        ]
+
+
+class FunctionGauge(FunctionCounter):
+    """
+    Gauge whose value is read from a function when collected
+    """
+
+    def collect(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.function()}",
+        ]
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # Bucket counts, sum and count per label values
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self.last_values: Dict[Tuple[str, ...], float] = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = ([0] * len(self.buckets), [0.0, 0])
+
+            bucket_counts, totals = self.values[label_values]
+
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[index] += 1
+                    break
+
+            totals[0] += value
+            totals[1] += 1
+            self.last_values[label_values] = value
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def get_last(self, *label_values: str) -> float:
+        return self.last_values.get(label_values, 0.0)
+
+    def collect(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+
+        with self.lock:
+            for label_values, (bucket_counts, totals) in self.values.items():
+                cumulative_count = 0
+
+                for upper_bound, count in zip(self.buckets, bucket_counts):
+                    cumulative_count += count
+                    labels = format_labels(
+                        self.label_names + ("le",), label_values + (str(upper_bound),)
+                    )
+                    lines.append(f"{self.name}_bucket{labels} {cumulative_count}")
+
+                labels = format_labels(
+                    self.label_names + ("le",), label_values + ("+Inf",)
+                )
+                lines.append(f"{self.name}_bucket{labels} {totals[1]}")
+                labels = format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {totals[0]}")
+                lines.append(f"{self.name}_count{labels} {totals[1]}")
+
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(
+        self, name: str, description: str, label_names: Tuple[str, ...] = ()
+    ) -> Counter:
+        counter = Counter(name, description, label_names)
+        self.metrics.append(counter)
+        return counter
+
+    def gauge(
+        self, name: str, description: str, label_names: Tuple[str, ...] = ()
+    ) -> Gauge:
+        gauge = Gauge(name, description, label_names)
+        self.metrics.append(gauge)
+        return gauge
+
+    def function_counter(
+        self, name: str, description: str, function: Callable[[], float]
+    ) -> FunctionCounter:
+        counter = FunctionCounter(name, description, function)
+        self.metrics.append(counter)
+        return counter
+
+    def function_gauge(
+        self, name: str, description: str, function: Callable[[], float]
+    ) -> FunctionGauge:
+        gauge = FunctionGauge(name, description, function)
+        self.metrics.append(gauge)
+        return gauge
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        histogram = Histogram(name, description, label_names, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        for metric in self.metrics:
+            lines += metric.collect()
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "spotibridge_stage_seconds",
+    "Duration of the stages from requesting the playback state to publishing the colors",
+    ("stage",),
+)
+TRACK_CHANGE_DELAY_SECONDS = REGISTRY.histogram(
+    "spotibridge_track_change_delay_seconds",
+    "Time from the start of a track until its colors have been published",
+    buckets=(0.5, 1, 2, 3, 5, 10, 20, 30, 60),
+)
+SPOTIFY_REQUESTS = REGISTRY.counter(
+    "spotibridge_spotify_requests_total",
+    "Requests to the Spotify API and CDN by endpoint and status",
+    ("endpoint", "status"),
+)
+SPOTIFY_RATE_LIMITED = REGISTRY.counter(
+    "spotibridge_spotify_rate_limited_total",
+    "Requests to the Spotify API that were answered with 429 Too Many Requests",
+    ("endpoint",),
+)
+SPOTIFY_REQUESTS_DEFERRED = REGISTRY.counter(
+    "spotibridge_spotify_requests_deferred_total",
+    "Requests that were not sent as the budget was used up or the governor backed off",
+    ("endpoint", "reason"),
+)
+HTTP_CACHE_LOOKUPS = REGISTRY.counter(
+    "spotibridge_http_cache_lookups_total",
+    "GET requests by whether the cached response was fresh, not modified or missing",
+    ("result",),
+)
+ANALYSIS_CACHE_LOOKUPS = REGISTRY.counter(
+    "spotibridge_analysis_cache_lookups_total",
+    "Lookups of cover analyses by the tier that answered them",
+    ("result",),
+)
+ANALYSIS_JOBS_DROPPED = REGISTRY.counter(
+    "spotibridge_analysis_jobs_dropped_total",
+    "Cover analyses that were dropped before their result was used, by reason",
+    ("reason",),
+)
+SCHEDULER_MISFIRES = REGISTRY.counter(
+    "spotibridge_scheduler_misfires_total",
+    "Scheduled runs that were skipped or started late",
+    ("job",),
+)
+STARTUP_SECONDS = REGISTRY.gauge(
+    "spotibridge_startup_seconds",
+    "Seconds from the start of the process until the end of a startup phase",
+    ("phase",),
+)
+LOG_MESSAGES = REGISTRY.counter(
+    "spotibridge_log_messages_total", "Logged messages by level", ("level",)
+)
+
+
+def get_uptime() -> float:
+    return time.monotonic() - START_TIME
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a line on stderr
+        pass
+
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serve the metrics of the registry on http://<host>:<port>/metrics from a daemon thread
+    """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,74 @@
+from typing import List, Tuple
+
+import numpy
+from PIL import Image, features
+
+# Quantizers implemented in C by Pillow, libimagequant is only available if Pillow was built with it
+QUANTIZE_METHODS = {
+    "mediancut": 0,
+    "maxcoverage": 1,
+    "fastoctree": 2,
+    "libimagequant": 3,
+}
+
+
+class PaletteExtractor:
+    """
+    Extracts the dominant colors of an image like ColorThief, but quantizes with Pillow.
+    Like ColorThief, transparent and almost white pixels are ignored.
+    """
+
+    def __init__(
+        self, color_count: int = 5, quality: int = 1, method: str = "mediancut"
+    ):
+        """
+        :param color_count: Maximum number of colors in the palette
+        :param quality: Only every n-th pixel is considered, 1 is the highest quality
+        :param method: One of QUANTIZE_METHODS
+        """
+        if method not in QUANTIZE_METHODS:
+            raise ValueError(f"Unknown quantize method {method}")
+
+        if method == "libimagequant" and not features.check("libimagequant"):
+            raise ValueError("Pillow was built without libimagequant")
+
+        self.color_count = color_count
+        self.quality = max(1, quality)
+        self.method = QUANTIZE_METHODS[method]
+
+    def get_pixels(self, image: Image.Image) -> numpy.ndarray:
+        """
+        :return: The considered pixels of the image as array of shape (n, 3)
+        """
+        if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+            pixels = numpy.asarray(image.convert("RGBA")).reshape(-1, 4)
+            pixels = pixels[:: self.quality]
+            pixels = pixels[pixels[:, 3] >= 125, :3]
+        else:
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+
+            pixels = numpy.asarray(image).reshape(-1, 3)[:: self.quality]
+
+        return pixels[~numpy.all(pixels > 250, axis=1)]
+
+    def get_palette(self, image: Image.Image) -> List[Tuple[int, int, int]]:
+        """
+        :return: Up to color_count colors, ordered by the number of pixels they represent
+        """
+        pixels = self.get_pixels(image)
+
+        if len(pixels) == 0:
+            return []
+
+        strip = Image.fromarray(
+            numpy.ascontiguousarray(pixels).reshape(1, -1, 3), "RGB"
+        )
+        quantized = strip.quantize(self.color_count, self.method)
+        palette = quantized.getpalette()
+        colors = sorted(quantized.getcolors(self.color_count), reverse=True)
+
+        return [
+            (palette[index * 3], palette[index * 3 + 1], palette[index * 3 + 2])
+            for _, index in colors
+        ]
@@ -0,0 +1,152 @@
+import re
+from enum import Flag
+from typing import Optional, List
+
+import requests
+
+# Market lists make up most of a track object, but are not used by the bridge
+AVAILABLE_MARKETS_PATTERN = re.compile(rb'"available_markets"\s*:\s*\[[^\]]*\]')
+
+
+def strip_available_markets(body: bytes) -> bytes:
+    """
+    Empty the available_markets lists of a JSON response before it is parsed
+    """
+    return AVAILABLE_MARKETS_PATTERN.sub(b'"available_markets":[]', body)
+
+
+def strip_available_markets_hook(response: requests.Response, *args, **kwargs):
+    """
+    Response hook of a requests session that strips the API responses
+    """
+    if response.headers.get("Content-Type", "").startswith("application/json"):
+        response._content = strip_available_markets(response.content)
+
+    return response
+
+
+def select_cover_url(images: List[dict], min_size: int) -> str:
+    """
+    Select the smallest rendition of an album cover that is at least min_size pixels wide
+    and high. Spotify lists the renditions from the largest to the smallest.
+    :param images: The image objects of the album
+    :param min_size: The minimum edge length in pixels
+    :return: The url of the rendition, the largest one if none is large enough
+    """
+    selected = images[0]
+
+    for image in images:
+        width, height = image.get("width"), image.get("height")
+
+        if width is None or height is None:
+            # Unknown size, e.g. for local files, so only the first one is used
+            continue
+
+        if min(width, height) < min_size:
+            continue
+
+        if (
+            selected.get("width") is None
+            or selected.get("height") is None
+            or width * height < selected["width"] * selected["height"]
+        ):
+            selected = image
+
+    return selected["url"]
+
+
+class PlaybackChange(Flag):
+    NONE = 0
+    # Playback started or stopped, a paused playback counts as stopped
+    PLAYING = 1
+    # Another track than the current one is playing
+    TRACK = 2
+    # The progress deviates from the time that has passed, e.g. because of a seek
+    PROGRESS = 4
+
+
+class PlaybackSnapshot:
+    """
+    The fields of a currently playing response the bridge uses
+    """
+
+    __slots__ = (
+        "track_id",
+        "title",
+        "duration_ms",
+        "progress_ms",
+        "album_id",
+        "images",
+    )
+
+    def __init__(
+        self,
+        track_id: str,
+        title: str,
+        duration_ms: int,
+        progress_ms: int,
+        album_id: str,
+        images: List[dict],
+    ):
+        self.track_id = track_id
+        self.title = title
+        self.duration_ms = duration_ms
+        self.progress_ms = progress_ms
+        self.album_id = album_id
+        self.images = images
+
+    @classmethod
+    def from_response(cls, response: Optional[dict]) -> Optional["PlaybackSnapshot"]:
+        """
+        :param response: The response of the currently playing endpoint
+        :return: None if the playback is stopped, paused or not a track
+        """
+        if response is None or not response["is_playing"]:
+            return None
+
+        item = response["item"]
+
+        if item is None:
+            return None
+
+        album = item["album"]
+        return cls(
+            item["id"],
+            item["name"],
+            item["duration_ms"],
+            response["progress_ms"],
+            album["id"],
+            album["images"],
+        )
+
+    def __repr__(self):
+        return f"{{PlaybackSnapshot: {self.track_id} at {self.progress_ms}ms}}"
+
+
+def diff_playback(
+    previous: Optional[PlaybackSnapshot],
+    current: Optional[PlaybackSnapshot],
+    elapsed_ms: float,
+    tolerance_ms: float,
+) -> PlaybackChange:
+    """
+    Compare two snapshots of the playback
+    :param elapsed_ms: Milliseconds between the snapshots
+    :param tolerance_ms: Deviation of the progress from the elapsed time that is ignored
+    :return: The changes, PlaybackChange.NONE if the track just played on
+    """
+    if previous is None or current is None:
+        if previous is current:
+            return PlaybackChange.NONE
+
+        return PlaybackChange.PLAYING
+
+    changes = PlaybackChange.NONE
+
+    if previous.track_id != current.track_id:
+        changes |= PlaybackChange.TRACK
+
+    if abs(current.progress_ms - previous.progress_ms - elapsed_ms) > tolerance_ms:
+        changes |= PlaybackChange.PROGRESS
+
+    return changes
@@ -0,0 +1,52 @@
+from datetime import datetime
+from typing import Optional
+
+
+class PollingPolicy:
+    """
+    Decides how long to wait until the playback state is requested again. Polls rarely
+    in the middle of a track, densely around the predicted end of the track and backs off
+    exponentially while nothing is playing.
+    """
+
+    def __init__(
+        self,
+        min_interval: float,
+        max_interval: float,
+        boundary_window: float,
+        idle_max_interval: float,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.boundary_window = boundary_window
+        self.idle_max_interval = idle_max_interval
+        self.idle_interval: Optional[float] = None
+
+    def get_next_interval(
+        self, now: datetime, next_change: Optional[datetime]
+    ) -> float:
+        """
+        Return the number of seconds until the next poll
+        :param now: The current time
+        :param next_change: The predicted end of the current track or None if nothing is playing
+        :return: The interval in seconds
+        """
+        if next_change is None:
+            if self.idle_interval is None:
+                self.idle_interval = self.min_interval
+            else:
+                self.idle_interval = min(self.idle_max_interval, self.idle_interval * 2)
+
+            return self.idle_interval
+
+        self.idle_interval = None
+        seconds_until_change = (next_change - now).total_seconds()
+
+        if seconds_until_change <= self.boundary_window:
+            # Inside the window around the boundary or the prediction is already overdue
+            return self.min_interval
+
+        return max(
+            self.min_interval,
+            min(self.max_interval, seconds_until_change - self.boundary_window),
+        )
@@ -0,0 +1,68 @@
+import json
+import os
+from threading import Lock
+from typing import NamedTuple, Tuple, List, Optional, Dict
+
+from logger import get_logger
+
+
+class PlayerState(NamedTuple):
+    # The track whose analysed colors are published, None while stopped
+    current_track: Optional[str]
+    title: str
+    is_playing: bool
+    color: Tuple[int, int, int]
+    palette: List[Tuple[int, int, int]]
+
+
+class StateStore:
+    """
+    Snapshot of the last published state of every player in a JSON file, so a restarted
+    bridge publishes the same values again instead of resetting them until the first poll.
+    The file is replaced atomically whenever the state of a track is final.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = get_logger("StateStore")
+        self.states: Dict[str, PlayerState] = {}
+        self.lock = Lock()
+
+        try:
+            with open(path) as file:
+                states = json.load(file)
+
+            for device_id, state in states.items():
+                self.states[device_id] = PlayerState(
+                    state["current_track"],
+                    state["title"],
+                    state["is_playing"],
+                    tuple(state["color"]),
+                    [tuple(color) for color in state["palette"]],
+                )
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as ex:
+            self.logger.warning(f"Ignoring the state snapshot {path}: {ex}")
+
+    def get(self, device_id: str) -> Optional[PlayerState]:
+        return self.states.get(device_id)
+
+    def put(self, device_id: str, state: PlayerState):
+        with self.lock:
+            if self.states.get(device_id) == state:
+                return
+
+            self.states[device_id] = state
+            temporary_path = f"{self.path}.tmp"
+
+            try:
+                with open(temporary_path, "w") as file:
+                    json.dump(
+                        {key: value._asdict() for key, value in self.states.items()},
+                        file,
+                    )
+
+                os.replace(temporary_path, self.path)
+            except OSError as ex:
+                self.logger.warning(f"Failed to save the state snapshot: {ex}")
@@ -0,0 +1,166 @@
+import time
+from threading import Lock, Event
+from typing import Tuple, List, Dict, Optional
+
+from homie import HomieProperty
+
+Color = Tuple[int, int, int]
+# A color and its formatted payload
+Frame = Tuple[Color, str]
+
+
+def format_color(color: Color) -> str:
+    return f"{color[0]},{color[1]},{color[2]}"
+
+
+def get_easing_table(frame_count: int) -> List[float]:
+    """
+    Smoothstep weights of the target color for every frame of a transition, the start
+    color itself is not part of the transition
+    """
+    weights = []
+
+    for index in range(1, frame_count + 1):
+        progress = index / frame_count
+        weights.append(progress * progress * (3 - 2 * progress))
+
+    return weights
+
+
+class ColorStream:
+    def __init__(self, homie_property: HomieProperty):
+        self.topic = homie_property.get_topic()
+        self.device = homie_property.parent_node.parent_device
+        self.frames: List[Frame] = []
+        self.index = 0
+        # Index the frames are repeated from after the last one, if the palette is cycled
+        self.loop_start: Optional[int] = None
+        self.color: Color = (0, 0, 0)
+        self.payload: Optional[str] = None
+
+
+class TransitionStreamer:
+    """
+    Streams interpolated colors of several homie properties from a single timer. The frames
+    of a transition are computed once when the colors change, so publishing a frame is a
+    lookup. Frames are sent with QoS 0 and without retain and repeated frames are skipped.
+    """
+
+    def __init__(
+        self,
+        frame_rate: float = 10,
+        duration: float = 1,
+        palette_hold: Optional[float] = None,
+    ):
+        """
+        :param frame_rate: Frames per second
+        :param duration: Duration of a transition in seconds
+        :param palette_hold: Seconds every palette color is held before fading to the next
+        one, the palette is not cycled if None
+        """
+        self.interval = 1 / frame_rate
+        self.weights = get_easing_table(max(1, round(duration * frame_rate)))
+        self.hold_frame_count = (
+            None if palette_hold is None else max(1, round(palette_hold * frame_rate))
+        )
+        self.streams: Dict[str, ColorStream] = {}
+        self.lock = Lock()
+        self.wake = Event()
+
+    def add_stream(self, key: str, homie_property: HomieProperty):
+        with self.lock:
+            self.streams[key] = ColorStream(homie_property)
+
+    def get_transition(self, start: Color, end: Color) -> List[Frame]:
+        frames = []
+
+        for weight in self.weights:
+            color = (
+                round(start[0] + (end[0] - start[0]) * weight),
+                round(start[1] + (end[1] - start[1]) * weight),
+                round(start[2] + (end[2] - start[2]) * weight),
+            )
+            frames.append((color, format_color(color)))
+
+        return frames
+
+    def set_colors(
+        self, key: str, color: Color, palette: List[Color], fade: bool = True
+    ):
+        """
+        Fade the stream from its current color to a new color, then cycle through the palette
+        :param fade: If False, the stream starts at the new color, e.g. when it is restored
+        """
+        with self.lock:
+            stream = self.streams[key]
+
+            if not fade:
+                stream.color = color
+
+            frames = self.get_transition(stream.color, color)
+            loop_start = None
+
+            if self.hold_frame_count is not None and palette:
+                loop_start = len(frames)
+                colors = [color] + palette
+
+                for start, end in zip(colors, colors[1:] + colors[:1]):
+                    frames += [frames[-1]] * self.hold_frame_count
+                    frames += self.get_transition(start, end)
+
+            stream.frames = frames
+            stream.index = 0
+            stream.loop_start = loop_start
+
+        self.wake.set()
+
+    def publish_frames(self) -> bool:
+        """
+        Publish the next frame of every stream
+        :return: True if any stream is still running
+        """
+        running = False
+        due: List[Tuple[ColorStream, str]] = []
+
+        with self.lock:
+            for stream in self.streams.values():
+                if stream.index >= len(stream.frames):
+                    if stream.loop_start is None:
+                        continue
+
+                    stream.index = stream.loop_start
+
+                stream.color, payload = stream.frames[stream.index]
+                stream.index += 1
+                running = True
+
+                if payload != stream.payload:
+                    stream.payload = payload
+                    due.append((stream, payload))
+
+        for stream, payload in due:
+            stream.device.publish(stream.topic, payload, retain=False, qos=0)
+
+        return running
+
+    def run(self):
+        """
+        Publish the frames at the frame rate from the calling thread until the process exits
+        """
+        next_frame = time.monotonic()
+
+        while True:
+            if not self.publish_frames():
+                self.wake.wait()
+                self.wake.clear()
+                next_frame = time.monotonic()
+                continue
+
+            next_frame += self.interval
+            delay = next_frame - time.monotonic()
+
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Drop the frames that are already overdue instead of catching up
+                next_frame = time.monotonic()